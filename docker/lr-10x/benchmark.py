@@ -0,0 +1,562 @@
+import argparse
+import ctypes
+import os.path
+import random
+import resource
+import tempfile
+import time
+import timeit
+
+import numpy as np
+import pysam
+
+import tool
+from sequence_utils import reverse_complement
+
+
+def to_int_per_base(seq, lEle, dEle2Int):
+    """
+    Previous implementation of tool.to_int that fills the ctypes array one base at a time. Kept as the baseline for benchmark_encoding.
+    """
+    num_decl = len(seq) * ctypes.c_int8
+    num = num_decl()
+    for i, ele in enumerate(seq):
+        try:
+            n = dEle2Int[ele]
+        except KeyError:
+            n = dEle2Int[lEle[-1]]
+        finally:
+            num[i] = n
+
+    return num
+
+
+def random_sequence(length, rng):
+    """
+    Generates a random DNA sequence
+    :param length: Length of the sequence
+    :param rng: The random.Random object to use
+    :return: The sequence
+    """
+    return ''.join(rng.choices('ACGT', k=length))
+
+
+def benchmark_encoding(sequence_lengths, repeats, seed):
+    """
+    Times the encoding of read ends into ctypes numbers with tool.to_int and with the per-base baseline
+    :param sequence_lengths: List of read end lengths to benchmark
+    :param repeats: Number of encodings to time for each length
+    :param seed: Seed for generating the sequences
+    """
+    rng = random.Random(seed)
+    alphabet, letter_to_int, _ = tool.ssw_build_matrix()
+    translation_table = tool.build_translation_table(alphabet, letter_to_int)
+
+    print('length\tper_base_us\ttranslate_us\tspeedup')
+    for length in sequence_lengths:
+        sequence = random_sequence(length, rng)
+        assert list(to_int_per_base(sequence, alphabet, letter_to_int)) == list(tool.to_int(sequence, translation_table))
+
+        per_base = min(timeit.repeat(lambda: to_int_per_base(sequence, alphabet, letter_to_int), number=repeats, repeat=3)) / repeats
+        translate = min(timeit.repeat(lambda: tool.to_int(sequence, translation_table), number=repeats, repeat=3)) / repeats
+        print('{}\t{:.2f}\t{:.2f}\t{:.1f}x'.format(length, per_base * 1e6, translate * 1e6, per_base / translate))
+
+
+def simulate_observed_barcodes(num_cells, num_reads, error_rate, rng):
+    """
+    Simulates the observed barcode counts of a run. Cell abundances are log-normally distributed and each observed barcode has a
+    substitution error at one or two positions with probability error_rate.
+    :param num_cells: Number of true barcodes
+    :param num_reads: Number of reads with a barcode
+    :param error_rate: Probability of a read having a barcode with substitution errors
+    :param rng: The random.Random object to use
+    :return: dict of observed barcodes with the barcode sequences as keys and the number of observations as values
+    """
+    cells = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(num_cells)]
+    abundances = [rng.lognormvariate(0, 1) for _ in range(num_cells)]
+    observed_barcodes = dict()
+    for barcode in rng.choices(cells, weights=abundances, k=num_reads):
+        if rng.random() < error_rate:
+            barcode = list(barcode)
+            for position in rng.sample(range(tool.BARCODE_LENGTH), rng.choice((1, 1, 1, 2))):
+                barcode[position] = rng.choice([base for base in 'ACGT' if base != barcode[position]])
+            barcode = ''.join(barcode)
+        observed_barcodes[barcode] = observed_barcodes.get(barcode, 0) + 1
+    return observed_barcodes
+
+
+def benchmark_correction(num_cells, num_reads, error_rate, starcode_path, seed):
+    """
+    Times the barcode correction with the starcode executable and with the in-process corrector on simulated barcodes and reports how
+    many reads are corrected to the same barcode by both
+    :param num_cells: Number of true barcodes
+    :param num_reads: Number of reads with a barcode
+    :param error_rate: Probability of a read having a barcode with substitution errors
+    :param starcode_path: Path to the starcode executable. The starcode path is skipped if it does not exist.
+    :param seed: Seed for simulating the barcodes
+    """
+    rng = random.Random(seed)
+    observed_barcodes = simulate_observed_barcodes(num_cells, num_reads, error_rate, rng)
+    print('Simulated {:,} reads with {:,} unique barcodes'.format(num_reads, len(observed_barcodes)))
+
+    correction_dicts = dict()
+    engines = [('native', lambda stats: tool.perform_barcode_correction_native(observed_barcodes, None, stats))]
+    if os.path.exists(starcode_path):
+        engines.insert(0, ('starcode', lambda stats: tool.perform_barcode_correction_starcode(observed_barcodes, None, starcode_path, stats)))
+    else:
+        print('Starcode executable not found at {}, skipping the starcode path'.format(starcode_path))
+
+    print('engine\tseconds\tclusters')
+    for engine, perform_correction in engines:
+        stats = tool.AnalysisStats()
+        start = time.time()
+        correction_dicts[engine] = perform_correction(stats)
+        print('{}\t{:.2f}\t{:,}'.format(engine, time.time() - start, stats.starcode_clusters))
+
+    if len(correction_dicts) == 2:
+        agreeing_reads = sum(occurrence for barcode, occurrence in observed_barcodes.items()
+                             if correction_dicts['starcode'].get(barcode) == correction_dicts['native'].get(barcode))
+        print('Reads corrected to the same barcode: {:.4%}'.format(agreeing_reads / num_reads))
+
+
+def simulate_reads(num_reads, cells, adapter_sequence, tso_sequence, adapter_rate, barcode_error_rate, rng):
+    """
+    Simulates 10x reads with a known layout. A read with an adapter consists of a random flank, the adapter, the barcode of a cell, a
+    random UMI, a poly-T tail, a random cDNA sequence, and the reverse complemented TSO. It is reverse complemented with probability
+    0.5. The barcode has a substitution error with probability barcode_error_rate. Reads without an adapter are random sequences.
+    :param num_reads: Number of reads
+    :param cells: List of the true barcodes
+    :param adapter_sequence: The adapter sequence
+    :param tso_sequence: The TSO sequence
+    :param adapter_rate: Probability of a read having the adapter
+    :param barcode_error_rate: Probability of a read having a barcode with a substitution error
+    :param rng: The random.Random object to use
+    :return: List of the read sequences, list of the truth of each read as a tuple of whether the read is forward (None if it has no adapter), the barcode in the read, the barcode of the cell, and the UMI
+    """
+    sequences = []
+    truth = []
+    for _ in range(num_reads):
+        cdna = random_sequence(rng.randint(200, 2000), rng)
+        if rng.random() >= adapter_rate:
+            sequences.append(cdna)
+            truth.append((None, None, None, None))
+            continue
+
+        cell_barcode = rng.choice(cells)
+        barcode = cell_barcode
+        if rng.random() < barcode_error_rate:
+            position = rng.randrange(tool.BARCODE_LENGTH)
+            barcode = barcode[:position] + rng.choice([base for base in 'ACGT' if base != barcode[position]]) + barcode[position + 1:]
+        umi = random_sequence(tool.UMI_LENGTH, rng)
+        sequence = ''.join((random_sequence(rng.randint(0, 30), rng), adapter_sequence, barcode, umi, 'T' * 30, cdna, reverse_complement(tso_sequence)))
+
+        is_forward = rng.random() < 0.5
+        sequences.append(sequence if is_forward else reverse_complement(sequence))
+        truth.append((is_forward, barcode, cell_barcode, umi))
+    return sequences, truth
+
+
+def write_reads(bam_filename, sequences):
+    """
+    Writes sequences as unaligned reads to a BAM file
+    :param bam_filename: Filename of the BAM file
+    :param sequences: List of the read sequences
+    """
+    header = {'HD': {'VN': '1.6', 'SO': 'unknown'}}
+    with pysam.AlignmentFile(bam_filename, 'wb', header=header) as bam_file:
+        for i, sequence in enumerate(sequences):
+            read = pysam.AlignedSegment(bam_file.header)
+            read.query_name = 'read{}'.format(i)
+            read.query_sequence = sequence
+            read.flag = 4
+            read.query_qualities = pysam.qualitystring_to_array('5' * len(sequence))
+            bam_file.write(read)
+
+
+def peak_rss_mb():
+    """
+    :return: The peak resident set size of this process in MiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    """
+    :return: The current resident set size of this process in MiB
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+
+
+def benchmark_soak(num_pairs, read_end_length, max_growth_mb, adapter_fasta_filename, tso_fasta_filename, ssw_path, seed):
+    """
+    Aligns num_pairs pairs of a read end and the adapter or TSO sequence through the ssw_lib wrappers and checks that the memory use
+    stays flat. In each round, the query profiles of the adapter and TSO sequences are created and closed, and the read ends are aligned
+    to them one at a time with CSsw.align() and as a batch with CSsw.align_batch().
+    :param num_pairs: Number of pairs to align
+    :param read_end_length: Length of the read ends
+    :param max_growth_mb: Maximum growth of the resident set size after the first round in MiB
+    :param adapter_fasta_filename: Filename of the FASTA file of the adapter sequence
+    :param tso_fasta_filename: Filename of the FASTA file of the TSO sequence
+    :param ssw_path: Path to the ssw library
+    :param seed: Seed for simulating the reads
+    """
+    rng = random.Random(seed)
+    with pysam.FastaFile(adapter_fasta_filename) as adapter_fasta_file:
+        adapter_sequence = adapter_fasta_file.fetch(reference='adapter_sequence')
+    with pysam.FastaFile(tso_fasta_filename) as tso_fasta_file:
+        tso_sequence = tso_fasta_file.fetch(reference='adapter_sequence')
+
+    cells = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(100)]
+    sequences, _ = simulate_reads(tool.READS_PER_BATCH // 2, cells, adapter_sequence, tso_sequence, 0.9, 0, rng)
+    five_prime_ends, three_prime_ends_reversed, _ = tool.extract_read_ends(sequences, read_end_length)
+    read_ends = five_prime_ends + three_prime_ends_reversed
+
+    ssw = tool.ssw_lib.CSsw(ssw_path)
+    alphabet, letter_to_int, mat = tool.ssw_build_matrix()
+    translation_table = tool.build_translation_table(alphabet, letter_to_int)
+    read_end_numbers = [tool.to_int(read_end, translation_table) for read_end in read_ends]
+    batch_numbers = tool.to_int(''.join(read_ends), translation_table)
+    lengths = np.array([len(read_end) for read_end in read_ends])
+    offsets = np.cumsum(lengths) - lengths
+    pairs_per_round = 2 * 2 * len(read_ends)
+
+    def align_round():
+        for sequence in (adapter_sequence, tso_sequence):
+            with ssw.init_profile(tool.to_int(sequence, translation_table), len(sequence), mat, len(alphabet), 2) as profile:
+                scores = []
+                for numbers in read_end_numbers:
+                    with ssw.align(profile, numbers, len(numbers), 2, 1, 0, 0, 0, 15) as result:
+                        scores.append(result.contents.nScore)
+                batch_scores, _, _ = ssw.align_batch(profile, batch_numbers, offsets, lengths, 2, 1, 15)
+            assert batch_scores.tolist() == scores
+
+    align_round()
+    baseline_rss = current_rss_mb()
+    max_rss = baseline_rss
+    pairs = pairs_per_round
+    report_interval = max(num_pairs // 10, pairs_per_round)
+    print('pairs\tseconds\trss_mb')
+    start = time.time()
+    while pairs < num_pairs:
+        align_round()
+        pairs += pairs_per_round
+        max_rss = max(max_rss, current_rss_mb())
+        if pairs % report_interval < pairs_per_round:
+            print('{:,}\t{:.0f}\t{:.1f}'.format(pairs, time.time() - start, current_rss_mb()))
+
+    print('Resident set size grew by {:.1f} MiB after the first round'.format(max_rss - baseline_rss))
+    assert max_rss - baseline_rss <= max_growth_mb
+
+
+def benchmark_aligners(num_reads, read_end_lengths, adapter_rate, adapter_fasta_filename, tso_fasta_filename, ssw_path, seed):
+    """
+    Times the alignment of the read ends of simulated reads with the ssw library and with the numpy aligner, and checks that the
+    alignment ends are the same
+    :param num_reads: Number of reads
+    :param read_end_lengths: List of read end lengths to benchmark
+    :param adapter_rate: Probability of a read having the adapter
+    :param adapter_fasta_filename: Filename of the FASTA file of the adapter sequence
+    :param tso_fasta_filename: Filename of the FASTA file of the TSO sequence
+    :param ssw_path: Path to the ssw library
+    :param seed: Seed for simulating the reads
+    """
+    rng = random.Random(seed)
+    with pysam.FastaFile(adapter_fasta_filename) as adapter_fasta_file:
+        adapter_sequence = adapter_fasta_file.fetch(reference='adapter_sequence')
+    with pysam.FastaFile(tso_fasta_filename) as tso_fasta_file:
+        tso_sequence = tso_fasta_file.fetch(reference='adapter_sequence')
+
+    cells = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(100)]
+    sequences, _ = simulate_reads(num_reads, cells, adapter_sequence, tso_sequence, adapter_rate, 0, rng)
+    print('Simulated {:,} reads'.format(num_reads))
+
+    print('length\taligner\tseconds\treads_per_second')
+    for read_end_length in read_end_lengths:
+        batches = [tool.extract_read_ends(batch, read_end_length)[:2] for batch in tool.read_batches(sequences, tool.READS_PER_BATCH)]
+        engine_alignment_ends = dict()
+        for engine in ('ssw', 'numpy'):
+            with tool.create_aligner(ssw_path, adapter_sequence, tso_sequence, alignment_engine=engine) as aligner:
+                start = time.time()
+                engine_alignment_ends[engine] = [aligner.align_batch(read_ends) for batch in batches for read_ends in batch]
+                seconds = time.time() - start
+            print('{}\t{}\t{:.2f}\t{:,.0f}'.format(read_end_length, engine, seconds, num_reads / seconds))
+        assert all(np.array_equal(ends, numpy_ends) for batch_ends, numpy_batch_ends in zip(engine_alignment_ends['ssw'], engine_alignment_ends['numpy'])
+                   for ends, numpy_ends in zip(batch_ends, numpy_batch_ends))
+
+
+def benchmark_alignment_threads(num_reads, read_end_length, adapter_rate, thread_counts, adapter_fasta_filename, tso_fasta_filename, ssw_path, seed):
+    """
+    Times the alignment of the read ends of simulated reads with tool.ThreadedAdapterAligner for each number of threads, against the
+    single-threaded tool.AdapterAligner, and checks that the alignment ends are the same
+    :param num_reads: Number of reads
+    :param read_end_length: Number of bases to look for the adapter in both ends of each read
+    :param adapter_rate: Probability of a read having the adapter
+    :param thread_counts: List of the numbers of threads to benchmark
+    :param adapter_fasta_filename: Filename of the FASTA file of the adapter sequence
+    :param tso_fasta_filename: Filename of the FASTA file of the TSO sequence
+    :param ssw_path: Path to the ssw library
+    :param seed: Seed for simulating the reads
+    """
+    rng = random.Random(seed)
+    with pysam.FastaFile(adapter_fasta_filename) as adapter_fasta_file:
+        adapter_sequence = adapter_fasta_file.fetch(reference='adapter_sequence')
+    with pysam.FastaFile(tso_fasta_filename) as tso_fasta_file:
+        tso_sequence = tso_fasta_file.fetch(reference='adapter_sequence')
+
+    cells = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(100)]
+    sequences, _ = simulate_reads(num_reads, cells, adapter_sequence, tso_sequence, adapter_rate, 0, rng)
+    batches = [tool.extract_read_ends(batch, read_end_length)[:2] for batch in tool.read_batches(sequences, tool.READS_PER_BATCH)]
+    print('Simulated {:,} reads, {} CPUs available'.format(num_reads, os.cpu_count()))
+
+    def align_all(aligner):
+        return [aligner.align_batch(read_ends) for batch in batches for read_ends in batch]
+
+    print('threads\tseconds\treads_per_second\tspeedup')
+    with tool.create_aligner(ssw_path, adapter_sequence, tso_sequence) as aligner:
+        start = time.time()
+        expected_alignment_ends = align_all(aligner)
+        baseline_seconds = time.time() - start
+    print('{}\t{:.2f}\t{:,.0f}\t{:.2f}x'.format('serial', baseline_seconds, num_reads / baseline_seconds, 1))
+
+    for threads in thread_counts:
+        with tool.ThreadedAdapterAligner(tool.ssw_lib.load_ssw(ssw_path), adapter_sequence, tso_sequence, threads) as aligner:
+            start = time.time()
+            alignment_ends = align_all(aligner)
+            seconds = time.time() - start
+        assert all(np.array_equal(ends, expected_ends) for batch_ends, expected_batch_ends in zip(alignment_ends, expected_alignment_ends)
+                   for ends, expected_ends in zip(batch_ends, expected_batch_ends))
+        print('{}\t{:.2f}\t{:,.0f}\t{:.2f}x'.format(threads, seconds, num_reads / seconds, baseline_seconds / seconds))
+    if max(thread_counts) > os.cpu_count():
+        print('Only {} CPUs are available, so the speedups of more threads show the overhead of the threads, not their scaling'.format(os.cpu_count()))
+
+
+def benchmark_pipeline(num_reads, num_cells, read_end_length, adapter_rate, barcode_error_rate, barcode_corrector, adapter_fasta_filename, tso_fasta_filename, ssw_path, starcode_path, seed):
+    """
+    Times the stages of the tool on a synthetic BAM file of simulated reads and checks the annotations against the simulated truth.
+    The annotation stages are timed separately, per read with process_barcode(), process_umi(), and process_poly_t() and per batch with
+    annotate_read_ends(), and their results are checked to be the same as those of annotate_reads().
+    :param num_reads: Number of reads
+    :param num_cells: Number of true barcodes. The whitelist contains these and as many random barcodes.
+    :param read_end_length: Number of bases to look for the adapter in both ends of each read
+    :param adapter_rate: Probability of a read having the adapter
+    :param barcode_error_rate: Probability of a read having a barcode with a substitution error
+    :param barcode_corrector: 'starcode' or 'native'
+    :param adapter_fasta_filename: Filename of the FASTA file of the adapter sequence
+    :param tso_fasta_filename: Filename of the FASTA file of the TSO sequence
+    :param ssw_path: Path to the ssw library
+    :param starcode_path: Path to the starcode executable
+    :param seed: Seed for simulating the reads
+    """
+    rng = random.Random(seed)
+    with pysam.FastaFile(adapter_fasta_filename) as adapter_fasta_file:
+        adapter_sequence = adapter_fasta_file.fetch(reference='adapter_sequence')
+    with pysam.FastaFile(tso_fasta_filename) as tso_fasta_file:
+        tso_sequence = tso_fasta_file.fetch(reference='adapter_sequence')
+
+    cells = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(num_cells)]
+    packed, _ = tool.pack_sequences(cells + [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(num_cells)], tool.BARCODE_LENGTH)
+    whitelist_10x = tool.BarcodeWhitelist(np.unique(packed.astype(np.uint32)))
+    sequences, truth = simulate_reads(num_reads, cells, adapter_sequence, tso_sequence, adapter_rate, barcode_error_rate, rng)
+    print('Simulated {:,} reads of {:,} cells'.format(num_reads, num_cells))
+
+    stage_seconds = []
+
+    def finish_stage(stage, start):
+        seconds = time.time() - start
+        stage_seconds.append(seconds)
+        print('{}\t{:.2f}\t{:,.0f}\t{:.0f}'.format(stage, seconds, num_reads / seconds if seconds > 0 else float('inf'), peak_rss_mb()))
+
+    with tempfile.TemporaryDirectory() as directory:
+        bam_filename = os.path.join(directory, 'reads.bam')
+        analysis_name = os.path.join(directory, 'benchmark')
+        write_reads(bam_filename, sequences)
+
+        print('stage\tseconds\treads_per_second\tpeak_rss_mb')
+        start = time.time()
+        with pysam.AlignmentFile(bam_filename, 'rb', check_sq=False) as bam_file:
+            header = bam_file.header
+            reads = list(bam_file.fetch(until_eof=True))
+        finish_stage('read_bam', start)
+
+        stats = tool.AnalysisStats()
+        ssw = tool.ssw_lib.load_ssw(ssw_path)
+        with tool.AdapterAligner(ssw, adapter_sequence, tso_sequence) as aligner:
+            start = time.time()
+            read_ends = []
+            for batch in tool.read_batches(reads, tool.READS_PER_BATCH):
+                read_sequences = [read.seq for read in batch]
+                five_prime_ends, three_prime_ends_reversed, reversed_tails = tool.extract_read_ends(read_sequences, read_end_length)
+                skipped_alignments = aligner.skipped_alignments
+                five_prime_alignment_ends, five_prime_tso_alignment_ends = aligner.align_batch(five_prime_ends)
+                three_prime_alignment_ends, three_prime_tso_alignment_ends = aligner.align_batch(three_prime_ends_reversed)
+                stats.alignments_skipped += aligner.skipped_alignments - skipped_alignments
+                for i, alignment_ends in enumerate(zip(five_prime_alignment_ends.tolist(), five_prime_tso_alignment_ends.tolist(),
+                                                       three_prime_alignment_ends.tolist(), three_prime_tso_alignment_ends.tolist())):
+                    stats.reads_seen += 1
+                    is_forward, adapter_alignment_end = tool.classify_alignments(stats, *(end if end >= 0 else None for end in alignment_ends))
+                    if is_forward is None:
+                        read_ends.append(None)
+                    else:
+                        read_ends.append((read_sequences[i] if is_forward else reversed_tails[i], adapter_alignment_end))
+            finish_stage('align', start)
+
+            start = time.time()
+            barcodes = [tool.process_barcode(read_end[0], read_end[1], stats, whitelist_10x, None) if read_end is not None else None for read_end in read_ends]
+            finish_stage('process_barcode', start)
+
+            start = time.time()
+            umis = [tool.process_umi(read_end[0], barcode[1], stats) if barcode is not None and barcode[0] is not None else None
+                    for read_end, barcode in zip(read_ends, barcodes)]
+            finish_stage('process_umi', start)
+
+            start = time.time()
+            for read_end, umi in zip(read_ends, umis):
+                if umi is not None and umi[0] is not None:
+                    tool.process_poly_t(read_end[0], umi[1], stats)
+            finish_stage('process_poly_t', start)
+
+            annotations = []
+            for read_end, barcode, umi in zip(read_ends, barcodes, umis):
+                if read_end is None:
+                    annotations.append((None, None, None))
+                else:
+                    annotations.append((aligner.adapter_sequence, barcode[0], umi[0] if umi is not None else None))
+
+            # The same three stages for batches of read ends, as annotate_reads() runs them
+            start = time.time()
+            found_read_ends = [read_end for read_end in read_ends if read_end is not None]
+            batch_annotations = []
+            for i in range(0, len(found_read_ends), tool.READS_PER_BATCH):
+                batch = found_read_ends[i:i + tool.READS_PER_BATCH]
+                batch_annotations.extend(tool.annotate_read_ends([sequence for sequence, _ in batch], [adapter_alignment_end for _, adapter_alignment_end in batch],
+                                                                 tool.AnalysisStats(), aligner.adapter_sequence, whitelist_10x, None))
+            finish_stage('annotate_read_ends', start)
+            assert batch_annotations == [annotation for annotation, read_end in zip(annotations, read_ends) if read_end is not None]
+
+            reference_stats = tool.AnalysisStats()
+            reference_annotations = [annotation for batch in tool.read_batches(reads, tool.READS_PER_BATCH)
+                                     for annotation in tool.annotate_reads(batch, reference_stats, aligner, read_end_length, whitelist_10x, None)]
+        assert annotations == reference_annotations, 'The timed stages do not annotate the reads like annotate_reads()'
+        assert vars(stats) == vars(reference_stats), 'The timed stages do not count the stats like annotate_reads()'
+
+        start = time.time()
+        observed_barcodes = dict()
+        with tool.IntermediateBamWriter(analysis_name + '.intermediate.bam', header) as writer:
+            for read, (adapter, barcode, umi) in zip(reads, annotations):
+                tool.count_observation(observed_barcodes, None, barcode, umi)
+                writer.write(read, adapter, barcode, umi)
+        finish_stage('intermediate_bam', start)
+        del reads
+
+        start = time.time()
+        if barcode_corrector == 'native':
+            correction_dict = tool.perform_barcode_correction_native(observed_barcodes, analysis_name, stats)
+        else:
+            correction_dict = tool.perform_barcode_correction_starcode(observed_barcodes, analysis_name, starcode_path, stats)
+        correction_dict['.'] = '.'
+        finish_stage('{}_correction'.format(barcode_corrector), start)
+
+        start = time.time()
+        tool.write_corrected_reads(correction_dict, analysis_name, stats, whitelist_10x, None, progress_reporter_args=dict(interval=float('inf')))
+        finish_stage('correct_barcodes_rewrite', start)
+        print('total\t{:.2f}\t{:,.0f}\t{:.0f}'.format(sum(stage_seconds), num_reads / sum(stage_seconds), peak_rss_mb()))
+
+        with pysam.AlignmentFile(analysis_name + '.bam', 'rb', check_sq=False) as output_file:
+            output_tags = [(read.get_tag(tool.ADAPTER_TAG), read.get_tag(tool.RAW_BARCODE_TAG), read.get_tag(tool.BARCODE_TAG), read.get_tag(tool.UMI_TAG))
+                           for read in output_file.fetch(until_eof=True)]
+
+    reads_with_adapter = sum(1 for is_forward, _, _, _ in truth if is_forward is not None)
+    adapter_found, adapter_false_positives, barcodes_correct, umis_correct, cell_barcodes_correct = 0, 0, 0, 0, 0
+    for (is_forward, barcode, cell_barcode, umi), (adapter_tag, barcode_tag, cell_barcode_tag, umi_tag) in zip(truth, output_tags):
+        if is_forward is None:
+            adapter_false_positives += adapter_tag != '.'
+            continue
+        adapter_found += adapter_tag != '.'
+        barcodes_correct += barcode_tag == barcode
+        umis_correct += umi_tag == umi
+        cell_barcodes_correct += cell_barcode_tag == cell_barcode
+
+    print('metric\tvalue')
+    print('alignments_skipped\t{:.4%}'.format(stats.alignments_skipped / (4 * num_reads)))
+    print('adapter_sensitivity\t{:.4%}'.format(adapter_found / reads_with_adapter))
+    print('adapter_false_positives\t{:,}'.format(adapter_false_positives))
+    print('raw_barcode_accuracy\t{:.4%}'.format(barcodes_correct / reads_with_adapter))
+    print('umi_accuracy\t{:.4%}'.format(umis_correct / reads_with_adapter))
+    print('poly_t_found\t{:.4%}'.format(stats.poly_t_found / reads_with_adapter))
+    print('corrected_barcode_accuracy\t{:.4%}'.format(cell_barcodes_correct / reads_with_adapter))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the hot path of the 10x annotation tool')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    encoding_parser = subparsers.add_parser('encoding', help='Encoding of read ends for the ssw algorithm')
+    encoding_parser.add_argument('--lengths', help='Read end lengths to benchmark', type=int, nargs='+', default=[22, 80, 250])
+    encoding_parser.add_argument('--repeats', help='Number of encodings to time for each length', type=int, default=10000)
+    encoding_parser.add_argument('--seed', help='Seed for generating the sequences', type=int, default=0)
+
+    correction_parser = subparsers.add_parser('correction', help='Barcode correction with starcode and with the in-process corrector')
+    correction_parser.add_argument('--cells', help='Number of true barcodes', type=int, default=5000)
+    correction_parser.add_argument('--reads', help='Number of reads with a barcode', type=int, default=1000000)
+    correction_parser.add_argument('--error-rate', help='Probability of a read having a barcode with substitution errors', type=float, default=0.1)
+    correction_parser.add_argument('--starcode-path', help='Path to the starcode executable', type=str, default='/lrma/starcode-master/starcode')
+    correction_parser.add_argument('--seed', help='Seed for simulating the barcodes', type=int, default=0)
+
+    aligners_parser = subparsers.add_parser('aligners', help='Alignment of read ends with the ssw library and with the numpy aligner')
+    aligners_parser.add_argument('--reads', help='Number of reads', type=int, default=20000)
+    aligners_parser.add_argument('--lengths', help='Read end lengths to benchmark', type=int, nargs='+', default=[80, 120, 250])
+    aligners_parser.add_argument('--adapter-rate', help='Probability of a read having the adapter', type=float, default=0.9)
+    aligners_parser.add_argument('--adapter', help='Adapter FASTA filename', type=str, default='/lrma/adapter_sequence.fasta')
+    aligners_parser.add_argument('--reverse-adapter', help='Reverse adapter FASTA filename', type=str, default='/lrma/reverse_adapter_sequence.fasta')
+    aligners_parser.add_argument('--ssw-path', help='Path to the Striped Smith-Waterman library', type=str, default='/lrma/ssw')
+    aligners_parser.add_argument('--seed', help='Seed for simulating the reads', type=int, default=0)
+
+    alignment_threads_parser = subparsers.add_parser('alignment-threads', help='Scaling of the alignment of read ends with the number of threads')
+    alignment_threads_parser.add_argument('--reads', help='Number of reads', type=int, default=20000)
+    alignment_threads_parser.add_argument('--read-end-length', help='Interval from both ends of the read in which to search for the adapter sequence', type=int, default=250)
+    alignment_threads_parser.add_argument('--adapter-rate', help='Probability of a read having the adapter', type=float, default=0.9)
+    alignment_threads_parser.add_argument('--threads', help='Numbers of threads to benchmark', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    alignment_threads_parser.add_argument('--adapter', help='Adapter FASTA filename', type=str, default='/lrma/adapter_sequence.fasta')
+    alignment_threads_parser.add_argument('--reverse-adapter', help='Reverse adapter FASTA filename', type=str, default='/lrma/reverse_adapter_sequence.fasta')
+    alignment_threads_parser.add_argument('--ssw-path', help='Path to the Striped Smith-Waterman library', type=str, default='/lrma/ssw')
+    alignment_threads_parser.add_argument('--seed', help='Seed for simulating the reads', type=int, default=0)
+
+    soak_parser = subparsers.add_parser('soak', help='Memory use of aligning many pairs through the ssw_lib wrappers')
+    soak_parser.add_argument('--pairs', help='Number of pairs of a read end and the adapter or TSO sequence to align', type=int, default=10000000)
+    soak_parser.add_argument('--read-end-length', help='Length of the read ends', type=int, default=80)
+    soak_parser.add_argument('--max-growth-mb', help='Maximum growth of the resident set size after the first round in MiB', type=float, default=4)
+    soak_parser.add_argument('--adapter', help='Adapter FASTA filename', type=str, default='/lrma/adapter_sequence.fasta')
+    soak_parser.add_argument('--reverse-adapter', help='Reverse adapter FASTA filename', type=str, default='/lrma/reverse_adapter_sequence.fasta')
+    soak_parser.add_argument('--ssw-path', help='Path to the Striped Smith-Waterman library', type=str, default='/lrma/ssw')
+    soak_parser.add_argument('--seed', help='Seed for simulating the reads', type=int, default=0)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Stages of the tool on a synthetic BAM file, with the accuracy of the annotations')
+    pipeline_parser.add_argument('--reads', help='Number of reads', type=int, default=100000)
+    pipeline_parser.add_argument('--cells', help='Number of true barcodes', type=int, default=1000)
+    pipeline_parser.add_argument('--read-end-length', help='Interval from both ends of the read in which to search for the adapter sequence', type=int, default=120)
+    pipeline_parser.add_argument('--adapter-rate', help='Probability of a read having the adapter', type=float, default=0.9)
+    pipeline_parser.add_argument('--error-rate', help='Probability of a read having a barcode with a substitution error', type=float, default=0.1)
+    pipeline_parser.add_argument('--barcode-corrector', help='Barcode correction engine', choices=['starcode', 'native'], default='starcode')
+    pipeline_parser.add_argument('--adapter', help='Adapter FASTA filename', type=str, default='/lrma/adapter_sequence.fasta')
+    pipeline_parser.add_argument('--reverse-adapter', help='Reverse adapter FASTA filename', type=str, default='/lrma/reverse_adapter_sequence.fasta')
+    pipeline_parser.add_argument('--ssw-path', help='Path to the Striped Smith-Waterman library', type=str, default='/lrma/ssw')
+    pipeline_parser.add_argument('--starcode-path', help='Path to the starcode executable', type=str, default='/lrma/starcode-master/starcode')
+    pipeline_parser.add_argument('--seed', help='Seed for simulating the reads', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'encoding':
+        benchmark_encoding(args.lengths, args.repeats, args.seed)
+    elif args.benchmark == 'correction':
+        benchmark_correction(args.cells, args.reads, args.error_rate, args.starcode_path, args.seed)
+    elif args.benchmark == 'aligners':
+        benchmark_aligners(args.reads, args.lengths, args.adapter_rate, args.adapter, args.reverse_adapter, args.ssw_path, args.seed)
+    elif args.benchmark == 'alignment-threads':
+        benchmark_alignment_threads(args.reads, args.read_end_length, args.adapter_rate, args.threads, args.adapter, args.reverse_adapter, args.ssw_path, args.seed)
+    elif args.benchmark == 'soak':
+        benchmark_soak(args.pairs, args.read_end_length, args.max_growth_mb, args.adapter, args.reverse_adapter, args.ssw_path, args.seed)
+    elif args.benchmark == 'pipeline':
+        benchmark_pipeline(args.reads, args.cells, args.read_end_length, args.adapter_rate, args.error_rate, args.barcode_corrector,
+                           args.adapter, args.reverse_adapter, args.ssw_path, args.starcode_path, args.seed)
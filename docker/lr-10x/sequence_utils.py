@@ -0,0 +1,38 @@
+"""
+Sequence helpers shared by the lr-10x tools
+"""
+
+# Complement of the IUPAC nucleotide codes, as used by Bio.Seq.reverse_complement
+COMPLEMENT_TABLE = str.maketrans('ACGTUMRWSYKVHDBNacgtumrwsykvhdbn', 'TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn')
+
+
+def reverse_complement(sequence):
+    """
+    Reverse complements a sequence
+    :param sequence: The sequence as a string
+    :return: The reverse complement of the sequence
+    """
+    return sequence[::-1].translate(COMPLEMENT_TABLE)
+
+
+def reverse_complement_head(sequence, length):
+    """
+    Returns the first bases of the reverse complement of a sequence, without reverse complementing the whole sequence
+    :param sequence: The sequence as a string
+    :param length: Number of bases of the reverse complement to return
+    :return: reverse_complement(sequence)[:length]
+    """
+    return sequence[:-length - 1:-1].translate(COMPLEMENT_TABLE) if length > 0 else ''
+
+
+def reverse_complement_heads(sequences, length):
+    """
+    Returns the first bases of the reverse complements of a list of sequences, using a single translation for all sequences
+    :param sequences: List of sequences as strings. The sequences must not contain newlines.
+    :param length: Number of bases of each reverse complement to return
+    :return: List of reverse_complement(sequence)[:length] for each sequence
+    """
+    if not sequences:
+        return []
+    # Reversing the joined tails also reverses their order, so they are joined in reverse order
+    return '\n'.join(sequence[-length:] if length > 0 else '' for sequence in reversed(sequences))[::-1].translate(COMPLEMENT_TABLE).split('\n')
@@ -6,8 +6,15 @@ By Yongan Zhao (March 2016)
 """
 
 import sys
+import os
 import os.path as op
 import ctypes as ct
+import numpy as np
+
+
+SSW_LIBRARY_NAME = 'libssw.so'
+# environment variable with the path of libssw.so, or of the directory that contains it
+SSW_LIBRARY_PATH_ENV = 'SSW_LIBRARY_PATH'
 
 
 
@@ -90,6 +97,127 @@ class CProfile(ct.Structure):
 
 
 
+# loaded libraries by the path they were looked up with, so that the search and the loading are only done once per process
+dLoadedLibraries = {}
+
+
+def find_library(sLibPath=None, bSearch=True):
+    """
+    Finds libssw.so in the given path, the path in the SSW_LIBRARY_PATH environment variable, the directories of LD_LIBRARY_PATH, and
+    the directories of sys.path, in this order
+    @param  sLibPath    path of libssw.so, or of the directory that contains it. Can be None to only search the other locations.
+    @param  bSearch     whether to search the other locations if libssw.so is not in sLibPath
+    @return the path of libssw.so, None if it is not found
+    """
+    lCandidates = [sLibPath]
+    if bSearch:
+        lCandidates.append(os.environ.get(SSW_LIBRARY_PATH_ENV))
+        lCandidates.extend(os.environ.get('LD_LIBRARY_PATH', '').split(os.pathsep))
+        lCandidates.extend(sys.path)
+    for sCandidate in lCandidates:
+        if not sCandidate:
+            continue
+        if op.isdir(sCandidate):
+            sCandidate = op.join(sCandidate, SSW_LIBRARY_NAME)
+        if op.isfile(sCandidate):
+            return sCandidate
+    return None
+
+
+def load_library(sLibPath=None):
+    """
+    Loads libssw.so, see find_library for the locations that are searched. The result is cached for each sLibPath.
+    @return the loaded library, None if it is not found
+    """
+    if sLibPath not in dLoadedLibraries:
+        sLibFile = find_library(sLibPath)
+        dLoadedLibraries[sLibPath] = ct.cdll.LoadLibrary(sLibFile) if sLibFile is not None else None
+    return dLoadedLibraries[sLibPath]
+
+
+def load_ssw(sLibPath=None):
+    """
+    Creates the aligner for the ssw functions: a CSsw object if libssw.so is found, otherwise a NumpySsw object, which computes the same
+    scores and ending positions in numpy
+    @param  sLibPath    path of libssw.so, or of the directory that contains it, see find_library
+    """
+    bSearched = sLibPath in dLoadedLibraries
+    if load_library(sLibPath) is None:
+        if not bSearched:
+            print('libssw.so not found, using the numpy aligner', file=sys.stderr)
+        return NumpySsw()
+    return CSsw(sLibPath)
+
+
+
+class Profile(object):
+    """
+    A query profile created by ssw_init. It is passed to the ssw functions in place of the profile pointer, and the native profile is
+    released by init_destroy when the profile is closed or its with block is left.
+    """
+    def __init__(self, ssw, pProfile):
+        """
+        @para   ssw         the CSsw object that created the profile
+        @para   pProfile    pointer to the query profile structure
+        """
+        self.ssw = ssw
+        self.pProfile = pProfile
+
+    @property
+    def _as_parameter_(self):
+        if self.pProfile is None:
+            raise ValueError('the query profile is closed')
+        return self.pProfile
+
+    @property
+    def contents(self):
+        return self._as_parameter_.contents
+
+    def close(self):
+        if self.pProfile is not None:
+            self.ssw.init_destroy(self.pProfile)
+            self.pProfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+class AlignResult(object):
+    """
+    An alignment result created by ssw_align. The fields of the native result structure are read through contents, and the native
+    result is released by align_destroy when the result is closed or its with block is left.
+    """
+    def __init__(self, ssw, pRes):
+        """
+        @para   ssw     the CSsw object that created the result
+        @para   pRes    address of the alignment result structure
+        """
+        self.ssw = ssw
+        self.pRes = pRes
+
+    @property
+    def contents(self):
+        if self.pRes is None:
+            raise ValueError('the alignment result is closed')
+        return CAlignRes.from_address(self.pRes)
+
+    def close(self):
+        if self.pRes is not None:
+            self.ssw.align_destroy_address(self.pRes)
+            self.pRes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
 class CSsw(object):
     """
     A class for libssw
@@ -99,24 +227,11 @@ class CSsw(object):
         init all para
         @para   sLibpath    argparse object
         """
-# load libssw
-        sLibName = 'libssw.so'
-        if sLibPath:
-# user doesn't give the path explicitly
-            if not op.exists(op.join(sLibPath, sLibName)):
-                print('libssw.so does not exist in the input path', file=sys.stderr)
-                sys.exit()
-            self.ssw = ct.cdll.LoadLibrary(op.join(sLibPath,sLibName))
-        else:
-# otherwise just search in PATH
-            bFound = False
-            for s in sys.path:
-                if op.exists(op.join(s,sLibName)):
-                    bFound = True
-                    self.ssw = ct.cdll.LoadLibrary(op.join(s,sLibName))
-            if bFound == False:
-                print('libssw.so does not exist in PATH', file=sys.stderr)
-                sys.exit()
+# load libssw, see find_library for the locations that are searched
+        self.ssw = load_library(sLibPath)
+        if self.ssw is None:
+            print('libssw.so does not exist in the input path, {}, LD_LIBRARY_PATH, or sys.path'.format(SSW_LIBRARY_PATH_ENV), file=sys.stderr)
+            sys.exit(1)
 
 # init ssw_init
         """
@@ -194,12 +309,202 @@ class CSsw(object):
         self.align_destroy = self.ssw.align_destroy
         self.align_destroy.argtypes = [ct.POINTER(CAlignRes)]
         self.align_destroy.restype = None
-
+# init the variants of ssw_align and align_destroy that are used by align_batch. They take and return plain addresses, so that no
+# ctypes array or pointer object has to be created for each alignment.
+        self.ssw_align_address = self.ssw['ssw_align']
+        self.ssw_align_address.argtypes = [ct.c_void_p, ct.c_void_p, ct.c_int32, ct.c_uint8, ct.c_uint8, ct.c_uint8, ct.c_uint16, ct.c_int32, ct.c_int32]
+        self.ssw_align_address.restype = ct.c_void_p
+        self.align_destroy_address = self.ssw['align_destroy']
+        self.align_destroy_address.argtypes = [ct.c_void_p]
+        self.align_destroy_address.restype = None
         #
         # self.mark_mismatch = self.ssw.mark_mismatch
         # self.mark_mismatch.argtypes = [ct.c_int32, ct.c_int32, ct.c_int32, ct.POINTER(ct.c_int8), ct.POINTER(ct.c_int8), ct.c_int32, ct.POINTER(ct.POINTER(ct.c_uint32)), ct.POINTER(ct.c_int32)]
         # self.mark_mismatch.restype = ct.c_int32
 
+    def init_profile(self, read, nReadLen, mat, n, nScoreSize):
+        """
+        Creates a query profile with ssw_init, see ssw_init for the parameters
+        @return a Profile, which releases the query profile when it is closed
+        """
+        return Profile(self, self.ssw_init(read, nReadLen, mat, n, nScoreSize))
+
+    def align(self, pProfile, ref, nRefLen, nGapOpen, nGapExt, nFlag, nFilterScore, nFilterDist, nMaskLen):
+        """
+        Aligns a target sequence to a query profile with ssw_align, see ssw_align for the parameters
+        @param  ref     the target sequence as numbers, e.g. a ctypes c_int8 array, a bytearray, or a numpy int8 array
+        @return an AlignResult, which releases the alignment result when it is closed
+        """
+        nAddress = np.frombuffer(ref, dtype=np.int8).ctypes.data
+        pRes = self.ssw_align_address(pProfile, nAddress, nRefLen, nGapOpen, nGapExt, nFlag, nFilterScore, nFilterDist, nMaskLen)
+        return AlignResult(self, pRes)
+
+    def align_batch(self, pProfile, sequences, offsets, lengths, nGapOpen, nGapExt, nMaskLen, nFlag=0, nFilterScore=0, nFilterDist=0):
+        """
+        Aligns many target sequences to the same query profile with ssw_align. The target sequences are numbers in one contiguous
+        buffer, and only the scores and the ending positions of the best alignments are returned, so the alignment results are
+        released right away.
+        @param  pProfile    the Profile created by init_profile, or a pointer to the query profile structure created by ssw_init
+        @param  sequences   buffer of the target sequences as numbers, e.g. a ctypes c_int8 array, a bytearray, or a numpy int8 array
+        @param  offsets     offset of each target sequence in the buffer
+        @param  lengths     length of each target sequence
+        @param  nGapOpen    the absolute value of gap open penalty
+        @param  nGapExt     the absolute value of gap extension penalty
+        @param  nMaskLen    the mask length for the sub-optimal alignment, see ssw_align
+        @param  nFlag, nFilterScore, nFilterDist    the flag and filters of ssw_align
+        @return numpy int32 arrays of the best alignment score, the 0-based best alignment ending position on the query, and the
+                0-based best alignment ending position on the target of each target sequence
+        """
+        buffer = np.frombuffer(sequences, dtype=np.int8)
+        nAddress = buffer.ctypes.data
+        nCount = len(offsets)
+        lScores = [0] * nCount
+        lQryEnds = [0] * nCount
+        lRefEnds = [0] * nCount
+
+        ssw_align = self.ssw_align_address
+        align_destroy = self.align_destroy_address
+        result_at = CAlignRes.from_address
+        for i, (nOffset, nLength) in enumerate(zip(np.asarray(offsets).tolist(), np.asarray(lengths).tolist())):
+            pRes = ssw_align(pProfile, nAddress + nOffset, nLength, nGapOpen, nGapExt, nFlag, nFilterScore, nFilterDist, nMaskLen)
+            res = result_at(pRes)
+            lScores[i] = res.nScore
+            lQryEnds[i] = res.nQryEnd
+            lRefEnds[i] = res.nRefEnd
+            align_destroy(pRes)
+
+        return np.array(lScores, dtype=np.int32), np.array(lQryEnds, dtype=np.int32), np.array(lRefEnds, dtype=np.int32)
+
+
+
+class NumpyAlignResult(object):
+    """
+    An alignment result of NumpySsw, with the same contents and context manager as AlignResult
+    """
+    def __init__(self, nScore, nQryEnd, nRefEnd):
+        self.contents = CAlignRes(nScore=nScore, nQryEnd=nQryEnd, nRefEnd=nRefEnd, nQryBeg=-1, nRefBeg=-1)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+class NumpySsw(object):
+    """
+    Computes the optimal score and ending positions of ssw_align in numpy, for environments without libssw.so and as a faster alternative
+    for short queries against a batch of short targets. The Smith-Waterman matrix of a batch of target sequences is filled one query
+    position at a time, so that the loop is over the short query sequence and each step is a numpy operation on all target positions of
+    the batch, in int16 if the scores fit. The gap along the target is resolved with a running maximum. Like ssw_align, the reported
+    ending position on the target is the first one with the optimal score, and the ending position on the query is the first one with
+    the optimal score at that target position. The sub-optimal alignment, the beginning positions, and the cigar are not computed.
+    """
+    # number of targets aligned together, which bounds the memory of the matrix to about nMaxBatchSize * query length * target length * 2 bytes
+    nMaxBatchSize = 1024
+
+    def init_profile(self, read, nReadLen, mat, n, nScoreSize):
+        """
+        Creates a query profile, see ssw_init for the parameters
+        @return a Profile, which can be closed like the profiles of CSsw
+        """
+        lRead = np.frombuffer(read, dtype=np.int8)[:nReadLen].astype(np.intp)
+        lMat = np.frombuffer(mat, dtype=np.int8)[:n * n].reshape(n, n).astype(np.int32)
+        return Profile(self, lMat[lRead])
+
+    def init_destroy(self, pProfile):
+        pass
+
+    def align(self, pProfile, ref, nRefLen, nGapOpen, nGapExt, nFlag, nFilterScore, nFilterDist, nMaskLen):
+        """
+        Aligns a target sequence to a query profile, see CSsw.align
+        @return a NumpyAlignResult
+        """
+        lScores, lQryEnds, lRefEnds = self.align_batch(pProfile, np.frombuffer(ref, dtype=np.int8)[:nRefLen], [0], [nRefLen], nGapOpen, nGapExt, nMaskLen)
+        return NumpyAlignResult(lScores[0], lQryEnds[0], lRefEnds[0])
+
+    def align_batch(self, pProfile, sequences, offsets, lengths, nGapOpen, nGapExt, nMaskLen, nFlag=0, nFilterScore=0, nFilterDist=0):
+        """
+        Aligns many target sequences to the same query profile, see CSsw.align_batch
+        """
+        offsets = np.asarray(offsets, dtype=np.intp)
+        lengths = np.asarray(lengths, dtype=np.intp)
+        buffer = np.frombuffer(sequences, dtype=np.int8)
+        lScores, lQryEnds, lRefEnds = [], [], []
+        for nStart in range(0, len(offsets), self.nMaxBatchSize):
+            nEnd = nStart + self.nMaxBatchSize
+            for lResults, lChunk in zip((lScores, lQryEnds, lRefEnds), self._align_chunk(getattr(pProfile, '_as_parameter_', pProfile), buffer, offsets[nStart:nEnd], lengths[nStart:nEnd], nGapOpen, nGapExt)):
+                lResults.append(lChunk)
+        if not lScores:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        return np.concatenate(lScores), np.concatenate(lQryEnds), np.concatenate(lRefEnds)
+
+    def _align_chunk(self, lProfile, buffer, offsets, lengths, nGapOpen, nGapExt):
+        nCount = len(offsets)
+        nCodes = lProfile.shape[1]
+        nWidth = max(int(lengths.max()) if nCount else 0, 1)
+        lPositions = np.arange(nWidth)
+        # The targets as one padded matrix with a row for each target position and a column for each target, so that the shifts
+        # along the target move whole rows. The positions after the end of each target have an extra padding code.
+        lIndices = np.where(lPositions[:, None] < lengths, offsets + lPositions[:, None], len(buffer))
+        lRef = np.append(buffer, nCodes).astype(np.intp)[lIndices]
+
+        # int16 matrices halve the memory traffic of each step, and are used if no score can overflow them. The padding code scores so
+        # low that no alignment can pass it.
+        nMaxScore = int(np.maximum(lProfile.max(axis=1), 0).sum()) + nWidth * nGapExt + nGapOpen
+        dtype = np.int16 if nMaxScore < (1 << 14) else np.int32
+        nNegative = -(1 << 14) if dtype == np.int16 else -(1 << 30)
+        lScoresByCode = np.concatenate([lProfile, np.full((len(lProfile), 1), nNegative)], axis=1).astype(dtype)
+        # the query positions with the same base have the same scores, so the scores of the targets are looked up once per base
+        lBaseScoresByCode, lQueryBases = np.unique(lScoresByCode, axis=0, return_inverse=True)
+        lBaseScores = [np.take(lBaseScoresByCode[nBase], lRef) for nBase in range(len(lBaseScoresByCode))]
+
+        # lH[i, j + 1] is H of query position i and target position j. lH[:, 0] stays 0 for the diagonal of the first target position.
+        lH = np.zeros((len(lProfile), nWidth + 1, nCount), dtype=dtype)
+        lF = np.full((nWidth, nCount), nNegative, dtype=dtype)
+        lD = np.empty((nWidth, nCount), dtype=dtype)
+        lE = np.empty((nWidth, nCount), dtype=dtype)
+        lShifted = np.empty((nWidth, nCount), dtype=dtype)
+        lZeros = np.zeros((nWidth, nCount), dtype=dtype)
+        lColumnMax = np.zeros((nWidth, nCount), dtype=dtype)
+        lGapSteps = (lPositions * nGapExt).astype(dtype)[:, None]
+        lPrevious = np.zeros((nWidth + 1, nCount), dtype=dtype)
+        for i, nBase in enumerate(lQueryBases.ravel().tolist()):
+            np.add(lPrevious[:-1], lBaseScores[nBase], out=lD)
+            # gap along the query
+            np.subtract(lF, nGapExt, out=lF)
+            np.subtract(lPrevious[1:], nGapOpen, out=lE)
+            np.maximum(lF, lE, out=lF)
+            np.maximum(lD, lF, out=lD)
+            np.maximum(lD, lZeros, out=lD)
+            # gap along the target: E[j] = max over k < j of D[k] - gapO - (j - 1 - k) * gapE. Opening it from H instead of D is never
+            # better, because extending a gap costs at most as much as opening one. The running maximum over k is computed by doubling
+            # the shift, which takes log2(nWidth) steps.
+            lE[0] = nNegative
+            np.add(lD[:-1], lGapSteps[:-1], out=lE[1:])
+            nShift = 1
+            while nShift < nWidth - 1:
+                lShifted[:nShift + 1] = lE[:nShift + 1]
+                np.maximum(lE[nShift + 1:], lE[1:-nShift], out=lShifted[nShift + 1:])
+                lE, lShifted = lShifted, lE
+                nShift *= 2
+            np.subtract(lE[1:], lGapSteps[:-1] + nGapOpen, out=lE[1:])
+            lCurrent = lH[i]
+            np.maximum(lD, lE, out=lCurrent[1:])
+            np.maximum(lColumnMax, lCurrent[1:], out=lColumnMax)
+            lPrevious = lCurrent
+
+        lScores = lColumnMax.max(axis=0)
+        lRefEnds = np.argmax(lColumnMax == lScores, axis=0)
+        lAll = np.arange(nCount)
+        lQryEnds = np.argmax(lH[:, lRefEnds + 1, lAll] == lScores, axis=0)
+        # ssw_align reports no ending position on the target for a score of 0
+        lRefEnds[lScores == 0] = -1
+        return lScores.astype(np.int32), lQryEnds.astype(np.int32), lRefEnds.astype(np.int32)
 
 
 def read_matrix(sFile):
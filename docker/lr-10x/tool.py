@@ -2,14 +2,29 @@ import subprocess
 
 import pysam
 import argparse
-from Bio.Seq import Seq
 import time
+import os
 import os.path
 import gzip
 import ctypes
+import itertools
+import multiprocessing
+import shutil
+import numpy as np
+import threading
 import sys
+import json
+import datetime
+import pickle
+import copy
+import heapq
+import tempfile
+import zlib
+import collections
+import concurrent.futures
 sys.path.append('/lrma')
 from ssw import ssw_lib
+from sequence_utils import reverse_complement_head, reverse_complement_heads
 
 BARCODE_LENGTH = 16
 UMI_LENGTH = 12
@@ -20,24 +35,176 @@ BARCODE_TAG = 'CB'
 RAW_BARCODE_TAG = 'CR'
 UMI_TAG = 'ZU'
 
-def read_barcodes(barcodes_filename):
+ANNOTATION_ADAPTER_FOUND = '+'
+
+# Maps the bytes of a sequence to 2-bit base codes. Bytes that are not A, C, G, or T are mapped to INVALID_BASE_CODE.
+INVALID_BASE_CODE = 255
+BASE_CODES = np.full(256, INVALID_BASE_CODE, dtype=np.uint8)
+for code, bases in enumerate((b'Aa', b'Cc', b'Gg', b'Tt')):
+    BASE_CODES[list(bases)] = code
+
+# Number of bases after the end of the adapter that are searched for the barcode, UMI, and poly-T tail. It is one base longer than
+# needed, so that the length checks in find_barcode, find_umi, and check_poly_t_ratio behave on a read end of read_end_length +
+# READ_END_PADDING bases as on the full read.
+READ_END_PADDING = BARCODE_LENGTH + UMI_LENGTH + POLY_T_LENGTH + 1
+
+READS_PER_BATCH = 1000
+READS_PER_SHARD = 20000
+
+STARCODE_WRITE_BLOCK_LINES = 65536
+
+# Location of the ssw library in the docker image, which is searched if no --ssw-path is given
+DEFAULT_SSW_PATH = '/lrma/ssw'
+
+# Tags that are written to the header lines of the FASTQ file, in the order of samtools fastq -T ZA,CR,ZU,CB
+FASTQ_TAGS = [ADAPTER_TAG, RAW_BARCODE_TAG, UMI_TAG, BARCODE_TAG]
+# Quality character of reads without base qualities, the default quality 1 of samtools fastq
+FASTQ_DEFAULT_QUALITY = chr(33 + 1)
+# Number of uncompressed bytes of FASTQ records that are compressed into one gzip member
+FASTQ_CHUNK_SIZE = 1 << 22
+FASTQ_COMPRESSION_LEVEL = 6
+
+PROGRESS_INTERVAL_SECONDS = 30
+
+# Number of (barcode, UMI) observations that BarcodeUmiCounter buffers before sorting them into a run, the number of runs it keeps in
+# memory before merging them, and the number of merged entries above which it spills them to disk
+COUNTER_BUFFER_SIZE = 1 << 20
+COUNTER_MAX_RUNS = 16
+COUNTER_SPILL_ENTRIES = 1 << 25
+
+
+def pack_codes(codes):
+    """
+    Packs a matrix of 2-bit base codes into integers, the first base in the most significant bits
+    :param codes: numpy uint8 matrix with one sequence of base codes per row. At most 32 columns.
+    :return: A numpy uint64 array of the packed sequences
+    """
+    shifts = np.arange(2 * (codes.shape[1] - 1), -1, -2, dtype=np.uint64)
+    return np.bitwise_or.reduce(codes.astype(np.uint64) << shifts, axis=1)
+
+
+def pack_sequences(sequences, length):
+    """
+    Packs DNA sequences into integers with 2 bits per base (A=0, C=1, G=2, T=3), the first base in the most significant bits
+    :param sequences: List of sequences
+    :param length: Length of the sequences. At most 32.
+    :return: A numpy uint64 array of the packed sequences, a boolean numpy array that is False for sequences that have a different length or contain letters other than A, C, G, and T (their packed value is 0)
+    """
+    packed = np.zeros(len(sequences), dtype=np.uint64)
+    valid = np.array([len(sequence) == length for sequence in sequences], dtype=bool)
+    if not valid.any():
+        return packed, valid
+
+    joined = ''.join(itertools.compress(sequences, valid)).encode('ascii')
+    codes = BASE_CODES[np.frombuffer(joined, dtype=np.uint8)].reshape(-1, length)
+    valid_codes = (codes != INVALID_BASE_CODE).all(axis=1)
+    valid_packed = pack_codes(codes)
+    valid_packed[~valid_codes] = 0
+
+    packed[valid] = valid_packed
+    valid[valid] = valid_codes
+    return packed, valid
+
+
+def unpack_sequences(packed, length):
+    """
+    Unpacks integers packed by pack_codes() into DNA sequences
+    :param packed: numpy uint64 array of packed sequences
+    :param length: Length of the sequences
+    :return: List of the sequences
+    """
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+    codes = ((packed.astype(np.uint64)[:, None] >> shifts) & np.uint64(3)).astype(np.uint8)
+    letters = np.frombuffer(b'ACGT', dtype=np.uint8)[codes]
+    return np.ascontiguousarray(letters).view('S{}'.format(length)).ravel().astype('U{}'.format(length)).tolist()
+
+
+class BarcodeWhitelist:
+    """
+    A set of barcodes of length BARCODE_LENGTH, stored as a sorted numpy array of 2-bit packed barcodes, i.e. 4 bytes per barcode.
+    Membership is tested by binary search.
+    """
+    # Translates a barcode into a base-4 number string for int(). Other letters are left as they are and make int() fail.
+    DIGITS = str.maketrans('ACGTacgt', '01230123')
+
+    def __init__(self, packed_barcodes):
+        """
+        :param packed_barcodes: Sorted numpy uint32 array of unique packed barcodes
+        """
+        self.packed_barcodes = packed_barcodes
+
+    def __contains__(self, barcode):
+        if len(barcode) != BARCODE_LENGTH:
+            return False
+        try:
+            packed_barcode = np.uint32(int(barcode.translate(BarcodeWhitelist.DIGITS), 4))
+        except ValueError:
+            return False
+        position = np.searchsorted(self.packed_barcodes, packed_barcode)
+        return bool(position < len(self.packed_barcodes) and self.packed_barcodes[position] == packed_barcode)
+
+    def contains_codes(self, codes):
+        """
+        Tests a batch of barcodes given as base codes for membership
+        :param codes: numpy uint8 matrix with the base codes of one barcode per row, as mapped by BASE_CODES
+        :return: A boolean numpy array of whether each barcode is in the whitelist
+        """
+        valid = (codes != INVALID_BASE_CODE).all(axis=1)
+        packed = pack_codes(np.where(valid[:, None], codes, 0)).astype(np.uint32)
+        positions = np.minimum(np.searchsorted(self.packed_barcodes, packed), len(self.packed_barcodes) - 1)
+        return valid & (self.packed_barcodes[positions] == packed) if len(self.packed_barcodes) else np.zeros(len(codes), dtype=bool)
+
+    def __len__(self):
+        return len(self.packed_barcodes)
+
+    def __reduce__(self):
+        return BarcodeWhitelist, (self.packed_barcodes,)
+
+
+def read_barcodes(barcodes_filename, write_cache=False):
     """
     Reads a line-separated file of barcodes. If a line ends with '-1', this suffix is removed. A gzip file is supported if the extension of the file is .gz
+    Barcodes that do not have length BARCODE_LENGTH or contain letters other than A, C, G, and T are skipped, since they can never match a barcode found in a read.
+    If a cache file <barcodes_filename>.npy exists that is newer than the barcode file, the packed barcodes are loaded from it instead.
     :param barcodes_filename: Filename of the barcode file.
-    :return: A set of barcodes.
+    :param write_cache: Whether to write the packed barcodes to the cache file
+    :return: A BarcodeWhitelist of the barcodes.
     """
-    barcodes = set()
+    cache_filename = barcodes_filename + '.npy'
+    if os.path.exists(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(barcodes_filename):
+        return BarcodeWhitelist(np.load(cache_filename))
+
     _, barcodes_file_extension = os.path.splitext(barcodes_filename)
     is_gzip = barcodes_file_extension == '.gz'
-    with (open(barcodes_filename) if not is_gzip else gzip.open(barcodes_filename)) as barcodes_file:
-        for line in barcodes_file:
-            if is_gzip:
-                line = line.decode('utf-8')
-            if line[-3:-1] == '-1':
-                barcodes.add(line[:-3])
-            else:
-                barcodes.add(line[:-1])
-    return barcodes
+    with (open(barcodes_filename, 'rb') if not is_gzip else gzip.open(barcodes_filename)) as barcodes_file:
+        data = barcodes_file.read()
+
+    # If all lines are barcodes with the same suffix, the barcodes are the first columns of a byte matrix of the file
+    lines = None
+    line_length = data.find(b'\n') + 1
+    if line_length in (BARCODE_LENGTH + 1, BARCODE_LENGTH + 3) and len(data) % line_length == 0:
+        lines = np.frombuffer(data, dtype=np.uint8).reshape(-1, line_length)
+        suffix = np.frombuffer(b'-1\n'[BARCODE_LENGTH - line_length:], dtype=np.uint8)
+        if not (lines[:, BARCODE_LENGTH:] == suffix).all():
+            lines = None
+
+    if lines is not None:
+        codes = BASE_CODES[lines[:, :BARCODE_LENGTH]]
+        packed = pack_codes(codes[(codes != INVALID_BASE_CODE).all(axis=1)])
+    else:
+        barcodes = [line[:-2] if line[-2:] == '-1' else line for line in data.decode('utf-8').splitlines()]
+        packed, valid = pack_sequences(barcodes, BARCODE_LENGTH)
+        packed = packed[valid]
+
+    # np.sort and a mask of the first occurrences is considerably faster than np.unique on millions of barcodes
+    packed_barcodes = np.sort(packed.astype(np.uint32))
+    if len(packed_barcodes) > 0:
+        packed_barcodes = packed_barcodes[np.concatenate(([True], packed_barcodes[1:] != packed_barcodes[:-1]))]
+
+    if write_cache:
+        np.save(cache_filename, packed_barcodes)
+
+    return BarcodeWhitelist(packed_barcodes)
 
 
 def find_barcode(sequence, adapter_alignment_end):
@@ -87,7 +254,8 @@ def check_poly_t_ratio(sequence, umi_position):
 class AnalysisStats:
     """
     Class for storing stats during processing of a file. Each parameter has to be specified in 3 places: the init
-    function, in the header string, and in the print_string function.
+    function, in the header string, and in the print_string function. The only exception is alignments_skipped, which is only
+    printed to the log, so that the stats file does not change with the alignment prefilter.
     """
     def __init__(self):
         self.reads_seen = 0
@@ -123,6 +291,7 @@ class AnalysisStats:
 
         self.starcode_clusters = 0
         self.corrected_from_no_list_to_10x = 0
+        self.alignments_skipped = 0
 
     print_header = ('reads_seen\t'
                     'adapter_found\t'
@@ -188,6 +357,186 @@ class AnalysisStats:
             self.starcode_clusters,
             self.corrected_from_no_list_to_10x)
 
+    def extrapolate_tso_counts(self, sample_interval):
+        """
+        Scales the TSO counts, which were only collected for every sample_interval-th read, to all reads
+        :param sample_interval: The interval of the reads that were aligned to the TSO sequence
+        """
+        for name in ('forward_tso_in_not_found', 'reverse_tso_in_not_found', 'both_tsos_in_not_found',
+                     'forward_tso_in_forward_found', 'reverse_tso_in_forward_found', 'both_tsos_in_forward_found',
+                     'forward_tso_in_reverse_found', 'reverse_tso_in_reverse_found', 'both_tsos_in_reverse_found'):
+            setattr(self, name, getattr(self, name) * sample_interval)
+
+    def extrapolated(self, sample_interval):
+        """
+        :param sample_interval: The interval of the reads that were aligned to the TSO sequence
+        :return: A copy of the stats with the TSO counts scaled to all reads, see extrapolate_tso_counts()
+        """
+        stats = copy.copy(self)
+        stats.extrapolate_tso_counts(sample_interval)
+        return stats
+
+    def merge(self, other):
+        """
+        Adds the counts of another AnalysisStats object, e.g. one collected by a worker process, to this object
+        :param other: The AnalysisStats object to add
+        """
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def write(self, filename):
+        """
+        Writes the stats to a file. The file is replaced atomically, so that it always contains a complete set of stats.
+        :param filename: Filename of the stats file
+        """
+        with open(filename + '.tmp', 'w') as stats_file:
+            stats_file.write(AnalysisStats.print_header)
+            stats_file.write(self.print_string())
+        os.replace(filename + '.tmp', filename)
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a processing stage at most once every interval seconds. Each report prints the number of processed reads,
+    the throughput, and the estimated time remaining, and optionally replaces a JSON progress file and a snapshot of the stats, so that
+    the progress and partial stats are available even if the run is killed.
+    """
+    def __init__(self, stage, total_reads=None, interval=PROGRESS_INTERVAL_SECONDS, progress_filename=None, stats=None, stats_filename=None, start_reads=0, start_fraction=0.0, tso_sample_interval=1):
+        """
+        :param stage: Name of the processing stage
+        :param total_reads: Number of reads the stage will process, used for the estimated time remaining. Can be None if unknown.
+        :param interval: Minimum number of seconds between reports
+        :param progress_filename: Filename of the JSON progress file. Can be None to not write a progress file.
+        :param stats: The AnalysisStats object to write snapshots of. Can be None to not write snapshots.
+        :param stats_filename: Filename of the stats snapshots
+        :param start_reads: Number of reads that were already processed when the stage was resumed from a checkpoint
+        :param start_fraction: Fraction of the input that was already processed when the stage was resumed from a checkpoint
+        :param tso_sample_interval: Interval of the reads that were aligned to the TSO sequence, if the TSO counts of the stats are not extrapolated yet
+        """
+        self.stage = stage
+        self.total_reads = total_reads
+        self.start_reads = start_reads
+        self.start_fraction = start_fraction
+        self.interval = interval
+        self.progress_filename = progress_filename
+        self.stats = stats
+        self.stats_filename = stats_filename
+        self.tso_sample_interval = tso_sample_interval
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+
+    def update(self, reads_processed, fraction_done=None):
+        """
+        Reports the progress if the last report is at least interval seconds ago
+        :param reads_processed: Number of reads processed so far in this stage
+        :param fraction_done: Fraction of the input processed so far, used for the estimated time remaining if the total number of reads is unknown
+        """
+        current_time = time.time()
+        if current_time - self.last_report_time >= self.interval:
+            self._report(reads_processed, fraction_done, current_time, False)
+
+    def finish(self, reads_processed):
+        """
+        Reports the progress at the end of the stage
+        :param reads_processed: Number of reads processed in this stage
+        """
+        self._report(reads_processed, 1.0, time.time(), True)
+
+    def _report(self, reads_processed, fraction_done, current_time, finished):
+        self.last_report_time = current_time
+        elapsed = current_time - self.start_time
+        reads_per_second = (reads_processed - self.start_reads) / elapsed if elapsed > 0 else 0.0
+
+        if self.total_reads:
+            fraction_done = min(reads_processed / self.total_reads, 1.0)
+        if finished:
+            eta = 0.0
+            remaining = 'done'
+        elif fraction_done and fraction_done > self.start_fraction:
+            eta = elapsed * (1 - fraction_done) / (fraction_done - self.start_fraction)
+            remaining = 'ETA {}'.format(datetime.timedelta(seconds=int(eta)))
+        else:
+            eta = None
+            remaining = 'ETA unknown'
+
+        print('{}: {:,} reads processed in {}, {:,.0f} reads/s, {}'.format(
+            self.stage, reads_processed, datetime.timedelta(seconds=int(elapsed)), reads_per_second, remaining), flush=True)
+
+        if self.progress_filename is not None:
+            progress = dict(stage=self.stage, reads_processed=reads_processed, total_reads=self.total_reads, fraction_done=fraction_done,
+                            elapsed_seconds=round(elapsed, 3), reads_per_second=round(reads_per_second, 3),
+                            eta_seconds=round(eta, 3) if eta is not None else None, finished=finished, timestamp=round(current_time, 3))
+            with open(self.progress_filename + '.tmp', 'w') as progress_file:
+                json.dump(progress, progress_file)
+            os.replace(self.progress_filename + '.tmp', self.progress_filename)
+
+        if self.stats is not None and self.stats_filename is not None:
+            stats = self.stats.extrapolated(self.tso_sample_interval) if self.tso_sample_interval > 1 else self.stats
+            stats.write(self.stats_filename)
+
+
+class AnnotationCheckpoint:
+    """
+    Periodically saves the state of the annotation, so that an interrupted run can be resumed instead of reprocessing the whole input.
+    The state holds the virtual offset of the next read in the input BAM file, the list of finished segment files of the intermediate
+    file, the stats, and the barcode and UMI counts. The segment files are kept next to the intermediate file until the annotation
+    is finished and they are concatenated.
+    """
+    def __init__(self, filename, interval, settings):
+        """
+        :param filename: Filename of the checkpoint file
+        :param interval: Minimum number of seconds between checkpoints
+        :param settings: dict of the settings of the run. A checkpoint is only resumed if it was saved with the same settings.
+        """
+        self.filename = filename
+        self.interval = interval
+        self.settings = settings
+        self.last_save_time = time.time()
+
+    @staticmethod
+    def new_state(record_umis):
+        """
+        :return: The state of an annotation that has not processed any reads yet
+        """
+        return dict(input_offset=None, segment_filenames=[], annotation_complete=False, stats=AnalysisStats(),
+                    observed_barcodes=dict(), observed_barcodes_umis=BarcodeUmiCounter() if record_umis else None)
+
+    def load(self):
+        """
+        :return: The saved state, None if there is no checkpoint file or it was saved with different settings
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, 'rb') as checkpoint_file:
+            settings, state = pickle.load(checkpoint_file)
+        if settings != self.settings:
+            print('Ignoring checkpoint {}, which was saved with different settings'.format(self.filename))
+            return None
+        return state
+
+    def due(self):
+        """
+        :return: Whether the last checkpoint is at least interval seconds ago
+        """
+        return time.time() - self.last_save_time >= self.interval
+
+    def save(self, state):
+        """
+        Saves the state. The checkpoint file is replaced atomically, so that an interrupted save keeps the previous checkpoint.
+        :param state: The state of the annotation
+        """
+        with open(self.filename + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump((self.settings, state), checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.filename + '.tmp', self.filename)
+        self.last_save_time = time.time()
+
+    def remove(self):
+        """
+        Removes the checkpoint file once the run is finished
+        """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
 
 def ssw_build_matrix(match_score=2, mismatch_score=1):
     """
@@ -217,74 +566,292 @@ def ssw_build_matrix(match_score=2, mismatch_score=1):
     return alphabet, letter_to_int, mat
 
 
-def to_int(seq, lEle, dEle2Int):
+def build_translation_table(alphabet, letter_to_int):
     """
-    Translates a sequence into ctypes numbers
-    @param  seq   a sequence
+    Builds a table for bytes.translate that maps each byte of a sequence to its number for the ssw algorithm. Letters that are not in the alphabet are mapped to the number of the last letter of the alphabet.
+    :param alphabet: The alphabet object for the ssw algorithm
+    :param letter_to_int: The dict to convert base letters to numbers
+    :return: A translation table of length 256
     """
-    num_decl = len(seq) * ctypes.c_int8
-    num = num_decl()
-    for i, ele in enumerate(seq):
-        try:
-            n = dEle2Int[ele]
-        except KeyError:
-            n = dEle2Int[lEle[-1]]
-        finally:
-            num[i] = n
+    unknown = letter_to_int[alphabet[-1]]
+    return bytes(letter_to_int.get(chr(i), unknown) for i in range(256))
 
-    return num
 
-def get_alignment(ssw, sequence, adapter_sequence, alphabet, letter_to_int, mat, open_penalty=2, extension_penalty=1):
+def to_int(seq, translation_table):
     """
-    Performs the alignment of the read end to the adapter sequence
-    :param ssw: ssw object for performing the Smith-Waterman alignment
-    :param sequence: The sequence of the read end
-    :param adapter_sequence: The adapter sequence to align to
-    :param alphabet: The alphabet object for the ssw algorithm
-    :param letter_to_int: The dict to convert base letters to numbers
-    :param mat: The match-mismatch score matrix for the ssw algorithm
-    :param open_penalty: The penalty for opening gaps in the alignment
-    :param extension_penalty: The penalty for extending gaps
-    :return: The position of the last base of the adapter sequence in the read end
+    Translates a sequence into ctypes numbers. The translation of the whole sequence and the copy into the ctypes array are each a single C-level operation.
+    :param seq: a sequence
+    :param translation_table: The table created by build_translation_table
+    :return: A ctypes array of numbers
     """
-    sequence_numbers = to_int(sequence, alphabet, letter_to_int)
-    adapter_numbers = to_int(adapter_sequence, alphabet, letter_to_int)
-
-    flag = 1
-    mask_length = len(adapter_sequence) // 2 if len(adapter_sequence) >= 30 else 15
+    seq_numbers = seq.encode('ascii').translate(translation_table)
+    return (ctypes.c_int8 * len(seq_numbers)).from_buffer_copy(seq_numbers)
 
-    qProfile = ssw.ssw_init(sequence_numbers, ctypes.c_int32(len(sequence)), mat, len(alphabet), 2)
 
-    res = ssw.ssw_align(qProfile, adapter_numbers, ctypes.c_int32(len(adapter_sequence)), open_penalty, extension_penalty, flag, 0, 0, mask_length)
+class AdapterAligner:
+    """
+    Aligns read ends to the adapter and TSO sequences using the Striped Smith-Waterman library. The adapter and TSO sequences are
+    encoded and turned into query profiles only once, and the read ends are aligned against these profiles. The native alignment
+    results are released as soon as the alignment end has been read, and the profiles are released by close().
 
-    return res.contents.nQryEnd if res.contents.nScore > 30 else None
+    A read end that contains the adapter or TSO sequence exactly has an alignment with the maximum possible score, for which the ssw
+    algorithm reports the end of the first exact occurrence. These alignments are resolved with str.find instead, which gives the
+    same results. The number of alignments resolved this way is counted in skipped_alignments.
+    """
+    def __init__(self, ssw, adapter_sequence, tso_sequence, open_penalty=2, extension_penalty=1, min_score=30, tso_sample_interval=1):
+        """
+        :param ssw: ssw object for performing the Smith-Waterman alignment
+        :param adapter_sequence: The adapter sequence to align to
+        :param tso_sequence: The TSO sequence to align to
+        :param open_penalty: The penalty for opening gaps in the alignment
+        :param extension_penalty: The penalty for extending gaps
+        :param min_score: Alignments with a score of at most this value are not considered a match
+        :param tso_sample_interval: annotate_reads() only aligns every tso_sample_interval-th read to the TSO sequence, which is only used for the TSO counts of the stats. 0 to align no read to the TSO sequence.
+        """
+        self.ssw = ssw
+        self.adapter_sequence = adapter_sequence
+        self.tso_sequence = tso_sequence
+        self.open_penalty = open_penalty
+        self.extension_penalty = extension_penalty
+        self.min_score = min_score
+        self.tso_sample_interval = tso_sample_interval
+        self.alphabet, self.letter_to_int, self.mat = ssw_build_matrix()
+        self.translation_table = build_translation_table(self.alphabet, self.letter_to_int)
+
+        self.skipped_alignments = 0
+
+        self.adapter_profile = self._build_profile(adapter_sequence)
+        self.tso_profile = self._build_profile(tso_sequence)
+
+    def _build_profile(self, sequence):
+        """
+        Encodes a static sequence and builds its query profile
+        :param sequence: The adapter or TSO sequence
+        :return: The encoded sequence, the query profile, the mask length for the ssw algorithm, and the sequence to find exact occurrences of (None if an exact occurrence is not guaranteed to be the best alignment)
+        """
+        sequence_numbers = to_int(sequence, self.translation_table)
+        profile = self.ssw.init_profile(sequence_numbers, len(sequence), self.mat, len(self.alphabet), 2)
+        mask_length = len(sequence) // 2 if len(sequence) >= 30 else 15
+
+        # An exact occurrence is the best alignment if each base scores highest against itself, and a match if that score is high enough
+        alphabet_size = len(self.alphabet)
+        scores = [self.mat[n * alphabet_size:(n + 1) * alphabet_size] for n in sequence_numbers]
+        exact_occurrence_is_best = set(sequence) <= set('ACGT') and all(row[n] == max(row) for n, row in zip(sequence_numbers, scores))
+        exact_occurrence_score = sum(row[n] for n, row in zip(sequence_numbers, scores))
+        anchor = sequence if exact_occurrence_is_best and exact_occurrence_score > self.min_score else None
+        return sequence_numbers, profile, mask_length, anchor
+
+    def _get_alignment(self, profile, sequence_numbers, sequence_length):
+        """
+        Performs the alignment of an encoded read end to a profiled sequence
+        :return: The position of the last base of the profiled sequence in the read end, -1 if the alignment score is too low
+        """
+        _, query_profile, mask_length, _ = profile
+        # Flag 0: only the scores and the alignment end positions are computed, which is all we need
+        with self.ssw.align(query_profile, sequence_numbers, sequence_length, self.open_penalty, self.extension_penalty, 0, 0, 0, mask_length) as result:
+            return result.contents.nRefEnd if result.contents.nScore > self.min_score else -1
+
+    def _align_read_end(self, profile, sequence, sequence_numbers):
+        """
+        Aligns a read end to a profiled sequence, or finds the first exact occurrence of the profiled sequence in the read end
+        :param profile: The profile created by _build_profile
+        :param sequence: The sequence of the read end
+        :param sequence_numbers: The encoded sequence of the read end
+        :return: The position of the last base of the profiled sequence in the read end, -1 if the alignment score is too low
+        """
+        anchor = profile[3]
+        if anchor is not None:
+            anchor_position = sequence.find(anchor)
+            if anchor_position >= 0:
+                self.skipped_alignments += 1
+                return anchor_position + len(anchor) - 1
+        return self._get_alignment(profile, sequence_numbers, len(sequence))
+
+    def align(self, sequence):
+        """
+        Performs the alignment of the read end to the adapter sequence and the TSO sequence
+        :param sequence: The sequence of the read end
+        :return: The position of the last base of the adapter sequence in the read end, the position of the last base of the TSO sequence in the read end. Either is None if the sequence is not found.
+        """
+        sequence_numbers = to_int(sequence, self.translation_table)
+        adapter_alignment_end = self._align_read_end(self.adapter_profile, sequence, sequence_numbers)
+        tso_alignment_end = self._align_read_end(self.tso_profile, sequence, sequence_numbers)
+        return (adapter_alignment_end if adapter_alignment_end >= 0 else None), (tso_alignment_end if tso_alignment_end >= 0 else None)
+
+    def _align_batch(self, profile, sequences, batch_numbers, offsets, lengths, indices):
+        """
+        Aligns some read ends of a batch to a profiled sequence with a single call of the batch API of the ssw library. The read ends
+        that contain the profiled sequence exactly are resolved with str.find first and are not aligned.
+        :param profile: The profile created by _build_profile
+        :param sequences: List of read end sequences
+        :param batch_numbers: The encoded read ends of the batch, concatenated
+        :param offsets: numpy array of the offset of each read end in batch_numbers
+        :param lengths: numpy array of the length of each read end
+        :param indices: Indices of the read ends to align
+        :return: numpy array of the positions of the last base of the profiled sequence in each read end. A position is -1 if the sequence is not found or the read end is not aligned.
+        """
+        _, query_profile, mask_length, anchor = profile
+        alignment_ends = np.full(len(sequences), -1, dtype=np.int32)
+        if anchor is not None:
+            unresolved_indices = []
+            for i in indices:
+                anchor_position = sequences[i].find(anchor)
+                if anchor_position >= 0:
+                    alignment_ends[i] = anchor_position + len(anchor) - 1
+                else:
+                    unresolved_indices.append(i)
+            self.skipped_alignments += len(indices) - len(unresolved_indices)
+            indices = unresolved_indices
+        indices = np.asarray(indices, dtype=np.int64)
+
+        # Flag 0: only the scores and the alignment end positions are computed, which is all we need
+        scores, _, reference_ends = self.ssw.align_batch(query_profile, batch_numbers, offsets[indices], lengths[indices],
+                                                          self.open_penalty, self.extension_penalty, mask_length)
+        alignment_ends[indices] = np.where(scores > self.min_score, reference_ends, -1)
+        return alignment_ends
+
+    def align_batch(self, sequences, tso_sampled=None):
+        """
+        Performs the alignments of a batch of read ends to the adapter sequence and the TSO sequence. The read ends are encoded together
+        and aligned to each profiled sequence with a single call of the batch API of the ssw library.
+        :param sequences: List of read end sequences
+        :param tso_sampled: List of whether to align each read end to the TSO sequence. Can be None to align all read ends.
+        :return: numpy arrays of the positions of the last base of the adapter sequence and of the TSO sequence in each read end. A position is -1 if the sequence is not found or not aligned.
+        """
+        batch_numbers = to_int(''.join(sequences), self.translation_table)
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        offsets = np.cumsum(lengths) - lengths
+
+        all_indices = range(len(sequences))
+        tso_indices = all_indices if tso_sampled is None else [i for i in all_indices if tso_sampled[i]]
+        adapter_alignment_ends = self._align_batch(self.adapter_profile, sequences, batch_numbers, offsets, lengths, all_indices)
+        tso_alignment_ends = self._align_batch(self.tso_profile, sequences, batch_numbers, offsets, lengths, tso_indices)
+        return adapter_alignment_ends, tso_alignment_ends
+
+    def close(self):
+        """
+        Releases the query profiles
+        """
+        for profile in (self.adapter_profile, self.tso_profile):
+            if profile is not None:
+                profile[1].close()
+        self.adapter_profile = None
+        self.tso_profile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ThreadedAdapterAligner:
+    """
+    Aligns read ends to the adapter and TSO sequences in a pool of threads. The Striped Smith-Waterman library is called through ctypes,
+    which releases the GIL during each alignment, so the threads align concurrently within one process. Each thread owns an
+    AdapterAligner with its own query profiles, and align_batch() splits each batch into one chunk per thread.
+    """
+    def __init__(self, ssw, adapter_sequence, tso_sequence, threads, **aligner_args):
+        """
+        :param ssw: ssw object for performing the Smith-Waterman alignment
+        :param adapter_sequence: The adapter sequence to align to
+        :param tso_sequence: The TSO sequence to align to
+        :param threads: Number of threads to align with
+        :param aligner_args: Keyword arguments for the AdapterAligner of each thread
+        """
+        self.aligners = [AdapterAligner(ssw, adapter_sequence, tso_sequence, **aligner_args) for _ in range(threads)]
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.adapter_sequence = adapter_sequence
+        self.tso_sequence = tso_sequence
+        self.tso_sample_interval = self.aligners[0].tso_sample_interval
+
+    @property
+    def skipped_alignments(self):
+        return sum(aligner.skipped_alignments for aligner in self.aligners)
+
+    def align(self, sequence):
+        """
+        Performs the alignment of a single read end in the calling thread, see AdapterAligner.align()
+        """
+        return self.aligners[0].align(sequence)
+
+    def align_batch(self, sequences, tso_sampled=None):
+        """
+        Performs the alignments of a batch of read ends in parallel, see AdapterAligner.align_batch()
+        """
+        chunk_size = max(-(-len(sequences) // len(self.aligners)), 1)
+        chunk_results = []
+        for aligner, start in zip(self.aligners, range(0, len(sequences), chunk_size)):
+            end = start + chunk_size
+            chunk_results.append(self.executor.submit(aligner.align_batch, sequences[start:end], tso_sampled[start:end] if tso_sampled is not None else None))
+        chunk_results = [chunk_result.result() for chunk_result in chunk_results]
+        if not chunk_results:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        return np.concatenate([adapter_alignment_ends for adapter_alignment_ends, _ in chunk_results]), np.concatenate([tso_alignment_ends for _, tso_alignment_ends in chunk_results])
+
+    def close(self):
+        """
+        Stops the threads and releases the query profiles
+        """
+        self.executor.shutdown()
+        for aligner in self.aligners:
+            aligner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def create_aligner(ssw_path, adapter_sequence, tso_sequence, tso_sample_interval=1, alignment_threads=1, alignment_engine='ssw'):
+    """
+    Creates the aligner of the read ends
+    :param ssw_path: Path to the ssw library. Can be None to use DEFAULT_SSW_PATH. If the library is not found there or in the other locations of ssw_lib.find_library, the alignments are computed in numpy.
+    :param adapter_sequence: The adapter sequence to align to
+    :param tso_sequence: The TSO sequence to align to
+    :param tso_sample_interval: Interval of the reads that are aligned to the TSO sequence. 0 to align no read to the TSO sequence.
+    :param alignment_threads: Number of threads to align with. With more than one thread, a ThreadedAdapterAligner is created.
+    :param alignment_engine: 'ssw' to align with the ssw library, 'numpy' to align with ssw_lib.NumpySsw, which gives the same results
+    :return: An AdapterAligner or ThreadedAdapterAligner object
+    """
+    ssw = ssw_lib.load_ssw(ssw_path if ssw_path is not None else DEFAULT_SSW_PATH) if alignment_engine == 'ssw' else ssw_lib.NumpySsw()
+    if alignment_threads > 1:
+        return ThreadedAdapterAligner(ssw, adapter_sequence, tso_sequence, alignment_threads, tso_sample_interval=tso_sample_interval)
+    return AdapterAligner(ssw, adapter_sequence, tso_sequence, tso_sample_interval=tso_sample_interval)
 
 
-def align(read, stats, ssw, alphabet, letter_to_int, mat, read_end_length, adapter_sequence, tso_sequence):
+def align(read, stats, aligner, read_end_length):
     """
     Performs the alignment of the read end to the adapter sequence and the TSO sequence
     :param read: The read object
     :param stats: The AnalysisStats object
-    :param ssw: The ssw object
-    :param alphabet: The alphabet object for the ssw algorithm
-    :param letter_to_int: The dict to convert base letters to numbers
-    :param mat: The match-mismatch score matrix for the ssw algorithm
+    :param aligner: The AdapterAligner object
     :param read_end_length: Length of the read end that must include the adapter, barcode, UMI, and poly-T tail (recommended for PacBio: 80, recommended for Oxford Nanopore: 250)
-    :param adapter_sequence: The adapter sequence to align to
-    :param tso_sequence: The TSO sequence to align to
     :return: The sequence of the read end that the adapter was found in, the position of the last base of the adapter sequence in the read end
     """
     read_seq = read.seq
-    read_seq_reversed = str(Seq(read_seq).reverse_complement())
+    read_seq_reversed = reverse_complement_head(read_seq, read_end_length + READ_END_PADDING)
     five_prime_end = read_seq[:read_end_length]
     three_prime_end_reversed = read_seq_reversed[:read_end_length]
 
-    five_prime_alignment_end = get_alignment(ssw, five_prime_end, adapter_sequence, alphabet, letter_to_int, mat)
-    three_prime_alignment_end = get_alignment(ssw, three_prime_end_reversed, adapter_sequence, alphabet, letter_to_int, mat)
+    skipped_alignments = aligner.skipped_alignments
+    five_prime_alignment_end, five_prime_tso_alignment_end = aligner.align(five_prime_end)
+    three_prime_alignment_end, three_prime_tso_alignment_end = aligner.align(three_prime_end_reversed)
+    stats.alignments_skipped += aligner.skipped_alignments - skipped_alignments
 
-    five_prime_tso_alignment_end = get_alignment(ssw, five_prime_end, tso_sequence, alphabet, letter_to_int, mat)
-    three_prime_tso_alignment_end = get_alignment(ssw, three_prime_end_reversed, tso_sequence, alphabet, letter_to_int, mat)
+    is_forward, alignment_end = classify_alignments(stats, five_prime_alignment_end, five_prime_tso_alignment_end, three_prime_alignment_end, three_prime_tso_alignment_end)
+    if is_forward is None:
+        return None, None
+    return (read_seq if is_forward else read_seq_reversed), alignment_end
 
+
+def classify_alignments(stats, five_prime_alignment_end, five_prime_tso_alignment_end, three_prime_alignment_end, three_prime_tso_alignment_end):
+    """
+    Decides which end of a read the adapter was found in and counts the adapter and TSO alignments of the read
+    :param stats: The AnalysisStats object
+    :return: True if the adapter was found in the 5' end, False if it was found in the reverse complemented 3' end, None if it was found in neither or both ends. The position of the last base of the adapter sequence in that read end.
+    """
     if five_prime_alignment_end is None and three_prime_alignment_end is None:
         stats.adapter_not_found += 1
 
@@ -302,8 +869,8 @@ def align(read, stats, ssw, alphabet, letter_to_int, mat, read_end_length, adapt
         return None, None
 
     if five_prime_alignment_end:
+        is_forward = True
         alignment_end = five_prime_alignment_end
-        sequence = read_seq
 
         if five_prime_tso_alignment_end:
             if three_prime_tso_alignment_end:
@@ -313,8 +880,8 @@ def align(read, stats, ssw, alphabet, letter_to_int, mat, read_end_length, adapt
         elif three_prime_tso_alignment_end:
             stats.reverse_tso_in_forward_found += 1
     else:
+        is_forward = False
         alignment_end = three_prime_alignment_end
-        sequence = read_seq_reversed
 
         if five_prime_tso_alignment_end:
             if three_prime_tso_alignment_end:
@@ -326,7 +893,7 @@ def align(read, stats, ssw, alphabet, letter_to_int, mat, read_end_length, adapt
 
     # Valid adapter found
     stats.adapter_found += 1
-    return sequence, alignment_end
+    return is_forward, alignment_end
 
 
 def process_barcode(sequence, adapter_alignment_end, stats, whitelist_10x, whitelist_illumina):
@@ -408,13 +975,25 @@ def process_poly_t(sequence, umi_position, stats):
         return True
 
 
-def perform_barcode_correction_starcode(observed_barcodes, analysis_name, starcode_path, stats=None):
+def read_starcode_output(starcode_stdout, cluster_lines):
+    """
+    Collects the output lines of starcode. This runs in a separate thread, so starcode can never block on a full output pipe while
+    its input is still being written.
+    :param starcode_stdout: The stdout pipe of the starcode process
+    :param cluster_lines: List that the output lines are appended to
+    """
+    for cluster_line in starcode_stdout:
+        cluster_lines.append(cluster_line)
+
+
+def perform_barcode_correction_starcode(observed_barcodes, analysis_name, starcode_path, stats=None, counted_input=False):
     """
     Performs the barcode correction using starcode
     :param observed_barcodes: dict of observed barcodes with the barcode sequences as keys and the number of observations as values
     :param analysis_name: Prefix for the stats files
     :param starcode_path: Relative or absolute path to the starcode executable
     :param stats: The AnalysisStats file
+    :param counted_input: If True, each unique barcode is passed to starcode once together with its number of observations. Otherwise, each barcode is passed once per observation.
     :return: A dictionary with the raw barcodes as keys and the corresponding corrected barcodes as values
     """
     correction_dict = dict()
@@ -424,19 +1003,32 @@ def perform_barcode_correction_starcode(observed_barcodes, analysis_name, starco
     starcode_proc = subprocess.Popen(starcode_args, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
     encoding = 'ascii'
 
-    for (barcode, occurrence) in observed_barcodes.items():
-        for i in range(occurrence):
-            starcode_proc.stdin.write(bytearray(barcode + '\n', encoding=encoding))
+    cluster_lines = []
+    reader_thread = threading.Thread(target=read_starcode_output, args=(starcode_proc.stdout, cluster_lines))
+    reader_thread.start()
+
+    if counted_input:
+        input_lines = ('{}\t{}\n'.format(barcode, occurrence) for (barcode, occurrence) in observed_barcodes.items())
+    else:
+        input_lines = (barcode + '\n' for (barcode, occurrence) in observed_barcodes.items() for i in range(occurrence))
+
+    while True:
+        input_block = ''.join(itertools.islice(input_lines, STARCODE_WRITE_BLOCK_LINES))
+        if not input_block:
+            break
+        starcode_proc.stdin.write(input_block.encode(encoding))
 
     # Run starcode
     starcode_proc.stdin.close()
+    reader_thread.join()
+    starcode_proc.wait()
 
     starcode_output_file = open(analysis_name + '_starcode.tsv', 'w') if analysis_name is not None else None
     if starcode_output_file is not None:
         starcode_output_file.write('cluster\toccurrence\tindices\n')
 
     num_clusters = 0
-    for cluster_line in starcode_proc.stdout:
+    for cluster_line in cluster_lines:
         num_clusters += 1
         cluster_line = cluster_line.decode(encoding)
         cluster_data = cluster_line.strip().split('\t')
@@ -455,112 +1047,1032 @@ def perform_barcode_correction_starcode(observed_barcodes, analysis_name, starco
     return correction_dict
 
 
-def main(bam_filename, analysis_name, adapter_fasta_filename, tso_fasta_filename, whitelist_10x_filename, whitelist_illumina_filename, max_reads, contig, read_end_length, record_umis, ssw_path, starcode_path):
+def annotate_read(read, stats, aligner, read_end_length, whitelist_10x, whitelist_illumina):
     """
-    Main function for the tool
+    Searches a read for the adapter, barcode, UMI, and poly-T tail. This is the per-read reference implementation of annotate_reads(),
+    which aligns every read to the TSO sequence regardless of the tso_sample_interval of the aligner.
+    :param read: The read object
+    :param stats: The AnalysisStats object
+    :param aligner: The AdapterAligner object
+    :param read_end_length: Number of bases to look for the adapter, barcode, UMI, and poly-T tail in both ends of the read
+    :param whitelist_10x: Whitelist provided by 10x. Can be None, unless whitelist_illumina is None.
+    :param whitelist_illumina: Whitelist provided by short read sequencing. Can be None
+    :return: The adapter sequence, the raw barcode sequence, the raw UMI sequence. Each is None if not found.
+    """
+    stats.reads_seen += 1
+
+    sequence, adapter_alignment_end = align(read, stats, aligner, read_end_length)
+
+    return annotate_read_end(sequence, adapter_alignment_end, stats, aligner, whitelist_10x, whitelist_illumina)
+
+
+def annotate_read_end(sequence, adapter_alignment_end, stats, aligner, whitelist_10x, whitelist_illumina):
+    """
+    Searches the read end the adapter was found in for the barcode, UMI, and poly-T tail
+    :param sequence: The sequence of the read end that the adapter was found in. Can be None if the adapter was not found.
+    :param adapter_alignment_end: The position of the last base of the adapter sequence in the read end. Can be None if the adapter was not found.
+    :return: The adapter sequence, the raw barcode sequence, the raw UMI sequence. Each is None if not found.
+    """
+    if sequence is None or adapter_alignment_end is None:
+        return None, None, None
+
+    # Barcode
+    observed_barcode, observed_barcode_position, observed_barcode_in_10x, observed_barcode_in_illumina = process_barcode(sequence, adapter_alignment_end, stats, whitelist_10x, whitelist_illumina)
+    if observed_barcode is None:
+        return aligner.adapter_sequence, None, None
+
+    # UMI
+    observed_umi, observed_umi_position = process_umi(sequence, observed_barcode_position, stats)
+    if observed_umi is None:
+        return aligner.adapter_sequence, observed_barcode, None
+
+    # Poly-T
+    poly_t_found = process_poly_t(sequence, observed_umi_position, stats)
+    if not poly_t_found:
+        pass
+
+    return aligner.adapter_sequence, observed_barcode, observed_umi
+
+
+def annotate_read_ends(sequences, adapter_alignment_ends, stats, adapter_sequence, whitelist_10x, whitelist_illumina):
+    """
+    Searches a batch of read ends that the adapter was found in for the barcode, UMI, and poly-T tail. The bases after the adapter of
+    all read ends are gathered into a matrix with a single fancy indexing operation, and the barcodes, UMIs, and poly-T tails are
+    extracted, looked up in the whitelists, and counted column-wise. The results and the stats are the same as those of
+    annotate_read_end() for each read end.
+    :param sequences: List of the sequences of the read ends that the adapter was found in
+    :param adapter_alignment_ends: List of the positions of the last base of the adapter sequence in each read end
+    :param stats: The AnalysisStats object
+    :param adapter_sequence: The adapter sequence
+    :param whitelist_10x: Whitelist provided by 10x. Can be None, unless whitelist_illumina is None.
+    :param whitelist_illumina: Whitelist provided by short read sequencing. Can be None
+    :return: List of tuples of the adapter sequence, the raw barcode sequence, and the raw UMI sequence of each read end. The barcode and UMI are None if not found.
+    """
+    if not sequences:
+        return []
+
+    window_length = BARCODE_LENGTH + UMI_LENGTH + POLY_T_LENGTH
+    barcode_positions = np.array(adapter_alignment_ends, dtype=np.int64) + 1
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+
+    # Only the bases up to the end of the poly-T section are needed, the lengths of the sequences are kept for the length checks
+    heads = [sequence[:barcode_position + window_length] for sequence, barcode_position in zip(sequences, barcode_positions.tolist())]
+    head_starts = np.cumsum([0] + [len(head) for head in heads[:-1]])
+    bases = np.frombuffer(''.join(heads).encode('ascii'), dtype=np.uint8)
+    indices = (head_starts + barcode_positions)[:, None] + np.arange(window_length)
+    windows = bases[np.minimum(indices, len(bases) - 1)]
+
+    # The same length checks as in find_barcode, find_umi, and check_poly_t_ratio
+    barcode_found = barcode_positions + BARCODE_LENGTH < lengths
+    umi_found = barcode_found & (barcode_positions + BARCODE_LENGTH + UMI_LENGTH < lengths)
+    poly_t_checked = umi_found & (barcode_positions + window_length < lengths)
+    poly_t_ratios = (windows[:, BARCODE_LENGTH + UMI_LENGTH:] == ord('T')).sum(axis=1) / POLY_T_LENGTH
+
+    barcode_codes = BASE_CODES[windows[:, :BARCODE_LENGTH]]
+    barcode_in_10x = whitelist_10x.contains_codes(barcode_codes) & barcode_found if whitelist_10x is not None else np.zeros(len(sequences), dtype=bool)
+    barcode_in_illumina = whitelist_illumina.contains_codes(barcode_codes) & barcode_found if whitelist_illumina is not None else np.zeros(len(sequences), dtype=bool)
+
+    stats.barcode_not_found += int(np.count_nonzero(~barcode_found))
+    stats.barcode_found += int(np.count_nonzero(barcode_found))
+    stats.barcode_in_10x_and_illumina_whitelist += int(np.count_nonzero(barcode_in_10x & barcode_in_illumina))
+    stats.barcode_in_10x_whitelist += int(np.count_nonzero(barcode_in_10x & ~barcode_in_illumina))
+    stats.barcode_in_illumina_whitelist += int(np.count_nonzero(~barcode_in_10x & barcode_in_illumina))
+    stats.barcode_not_in_any_whitelist += int(np.count_nonzero(barcode_found & ~barcode_in_10x & ~barcode_in_illumina))
+    stats.sequence_too_short_for_umi += int(np.count_nonzero(barcode_found & ~umi_found))
+    stats.umi_found += int(np.count_nonzero(umi_found))
+    # A ratio of 0 counts as too short, as in process_poly_t
+    stats.sequence_too_short_for_poly_t += int(np.count_nonzero(umi_found & (~poly_t_checked | (poly_t_ratios == 0))))
+    stats.poly_t_not_found += int(np.count_nonzero(poly_t_checked & (poly_t_ratios > 0) & (poly_t_ratios < 0.9)))
+    stats.poly_t_found += int(np.count_nonzero(poly_t_checked & (poly_t_ratios >= 0.9)))
+
+    barcodes = np.ascontiguousarray(windows[:, :BARCODE_LENGTH]).view('S{}'.format(BARCODE_LENGTH)).ravel().astype('U{}'.format(BARCODE_LENGTH)).tolist()
+    umis = np.ascontiguousarray(windows[:, BARCODE_LENGTH:BARCODE_LENGTH + UMI_LENGTH]).view('S{}'.format(UMI_LENGTH)).ravel().astype('U{}'.format(UMI_LENGTH)).tolist()
+    return [(adapter_sequence, barcode if has_barcode else None, umi if has_umi else None)
+            for barcode, umi, has_barcode, has_umi in zip(barcodes, umis, barcode_found.tolist(), umi_found.tolist())]
+
+
+def extract_read_ends(read_sequences, read_end_length):
+    """
+    Extracts the 5' ends and the reverse complemented 3' ends of a batch of reads. The 3' ends of all reads are reverse complemented
+    with a single translation. Only the part of the reverse complemented read that can contain the adapter, barcode, UMI, and poly-T
+    tail is kept.
+    :param read_sequences: List of read sequences
+    :param read_end_length: Number of bases to look for the adapter in both ends of each read
+    :return: List of 5' ends, list of reverse complemented 3' ends, list of the reverse complemented read parts to search for the barcode, UMI, and poly-T tail
+    """
+    five_prime_ends = [read_seq[:read_end_length] for read_seq in read_sequences]
+    reversed_tails = reverse_complement_heads(read_sequences, read_end_length + READ_END_PADDING)
+    three_prime_ends_reversed = [reversed_tail[:read_end_length] for reversed_tail in reversed_tails]
+    return five_prime_ends, three_prime_ends_reversed, reversed_tails
+
+
+def annotate_reads(reads, stats, aligner, read_end_length, whitelist_10x, whitelist_illumina, first_read_index=0):
+    """
+    Searches a batch of reads for the adapter, barcode, UMI, and poly-T tail. The read ends are extracted and aligned in bulk, the
+    barcodes, UMIs, and poly-T tails are extracted with annotate_read_ends(). Only every aligner.tso_sample_interval-th read of the
+    input, counted by first_read_index and stats.reads_seen, is aligned to the TSO sequence, and the TSO counts of the other reads are
+    left out. With a tso_sample_interval of 1, the results and the stats are the same as those of annotate_read() for each read.
+    :param reads: List of read objects
+    :param stats: The AnalysisStats object
+    :param aligner: The AdapterAligner object
+    :param read_end_length: Number of bases to look for the adapter, barcode, UMI, and poly-T tail in both ends of the read
+    :param whitelist_10x: Whitelist provided by 10x. Can be None, unless whitelist_illumina is None.
+    :param whitelist_illumina: Whitelist provided by short read sequencing. Can be None
+    :param first_read_index: Index in the input of the first read counted by stats, e.g. of the first read of a shard
+    :return: List of tuples of the adapter sequence, the raw barcode sequence, and the raw UMI sequence of each read. Each is None if not found.
+    """
+    read_sequences = [read.seq for read in reads]
+    five_prime_ends, three_prime_ends_reversed, reversed_tails = extract_read_ends(read_sequences, read_end_length)
+
+    if aligner.tso_sample_interval == 1:
+        tso_sampled = None
+    elif aligner.tso_sample_interval == 0:
+        tso_sampled = [False] * len(reads)
+    else:
+        tso_sampled = [(first_read_index + stats.reads_seen + i) % aligner.tso_sample_interval == 0 for i in range(len(reads))]
+
+    skipped_alignments = aligner.skipped_alignments
+    five_prime_alignment_ends, five_prime_tso_alignment_ends = aligner.align_batch(five_prime_ends, tso_sampled)
+    three_prime_alignment_ends, three_prime_tso_alignment_ends = aligner.align_batch(three_prime_ends_reversed, tso_sampled)
+    stats.alignments_skipped += aligner.skipped_alignments - skipped_alignments
+
+    found_indices = []
+    found_sequences = []
+    adapter_alignment_ends = []
+    for i, alignment_ends in enumerate(zip(five_prime_alignment_ends.tolist(), five_prime_tso_alignment_ends.tolist(),
+                                           three_prime_alignment_ends.tolist(), three_prime_tso_alignment_ends.tolist())):
+        stats.reads_seen += 1
+        is_forward, adapter_alignment_end = classify_alignments(stats, *(end if end >= 0 else None for end in alignment_ends))
+        if is_forward is not None:
+            found_indices.append(i)
+            found_sequences.append(read_sequences[i] if is_forward else reversed_tails[i])
+            adapter_alignment_ends.append(adapter_alignment_end)
+
+    annotations = [(None, None, None)] * len(reads)
+    for i, annotation in zip(found_indices, annotate_read_ends(found_sequences, adapter_alignment_ends, stats, aligner.adapter_sequence, whitelist_10x, whitelist_illumina)):
+        annotations[i] = annotation
+    return annotations
+
+
+def read_batches(reads, batch_size):
+    """
+    Groups reads into lists of batch_size consecutive reads. The last list can be shorter.
+    """
+    reads = iter(reads)
+    while True:
+        batch = list(itertools.islice(reads, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def fetch_reads(bam_file, regions=None):
+    """
+    Iterates over the reads of the given regions, one region after the other, using the BAM index
+    :param bam_file: The open reads BAM file
+    :param regions: List of contig names or regions (chr:start-end). '*' is the unmapped reads without a position. Can be None to iterate over all reads of the file without an index.
+    :return: Iterator over the read objects
+    """
+    if regions is None:
+        return bam_file.fetch(until_eof=True)
+    return itertools.chain.from_iterable(bam_file.fetch(region=region) for region in regions)
+
+
+def list_contig_regions(bam_filename):
+    """
+    Lists the contigs of an indexed BAM file that have reads, in the order of the header, followed by '*' if there are unmapped reads
+    without a position. For a coordinate-sorted file, fetching these regions one after the other yields all reads in file order.
     :param bam_filename: Filename of the reads BAM file
-    :param analysis_name: Prefix for storing the analysis stats files
-    :param adapter_fasta_filename: Filename for the FASTA file of the adapter sequence
-    :param tso_fasta_filename: Filename for the FASTA file of the TSO sequence
-    :param whitelist_10x_filename: Filename of the 10x whitelist. Can be None or empty, unless whitelist_illumina_filename is None or empty
-    :param whitelist_illumina_filename: Filename of the Illumina whitelist. Can be None or empty
-    :param max_reads: Number of reads to process before stopping the processing. Can be None to process the entire file.
-    :param contig: Contig name to limit the processing to. Can be None to process all contigs.
-    :param read_end_length: Number of bases to look for the adapter, barcode, UMI, and poly-T tail in both ends of each read. Recommendatios for {PacBio: 80, Oxford Nanopore: 250)
-    :param record_umis: Whether or not to store the UMIs in a separate file
-    :param ssw_path: Path to the ssw library
-    :param starcode_path: Path to the starcode executable
+    :return: List of regions
     """
-    ssw = ssw_lib.CSsw(ssw_path)
+    with pysam.AlignmentFile(bam_filename, 'rb') as bam_file:
+        regions = [contig_stats.contig for contig_stats in bam_file.get_index_statistics() if contig_stats.total > 0]
+        if bam_file.nocoordinate > 0:
+            regions.append('*')
+    return regions
 
-    alphabet, letter_to_int, mat = ssw_build_matrix()
 
-    with pysam.FastaFile(adapter_fasta_filename) as adapter_fasta_file:
-        adapter_sequence = adapter_fasta_file.fetch(reference='adapter_sequence')
-    with pysam.FastaFile(tso_fasta_filename) as tso_fasta_file:
-        tso_sequence = tso_fasta_file.fetch(reference='adapter_sequence')
+def set_annotation_tags(read, adapter, barcode, umi):
+    """
+    Sets the adapter, raw barcode, and UMI tags of a read. Missing values are written as "."
+    :param read: The read object
+    :param adapter: The adapter sequence. Can be None
+    :param barcode: The raw barcode sequence. Can be None
+    :param umi: The raw UMI sequence. Can be None
+    """
+    read.set_tag(ADAPTER_TAG, adapter if adapter is not None else ".", value_type='Z')
+    read.set_tag(RAW_BARCODE_TAG, barcode if barcode is not None else ".", value_type='Z')
+    read.set_tag(UMI_TAG, umi if umi is not None else ".", value_type='Z')
+
+
+class IntermediateBamWriter:
+    """
+    Writes the annotated reads to the intermediate BAM file
+    """
+    def __init__(self, filename, header, compression_level=None, io_threads=1):
+        """
+        :param compression_level: BGZF compression level of the file, from 0 (uncompressed) to 9. Can be None to use the htslib default.
+        :param io_threads: Number of threads used for compressing the file
+        """
+        format_options = ['level={}'.format(compression_level)] if compression_level is not None else None
+        self.file = pysam.AlignmentFile(filename, 'wb', header=header, threads=io_threads, format_options=format_options)
+
+    def write(self, read, adapter, barcode, umi):
+        set_annotation_tags(read, adapter, barcode, umi)
+        self.file.write(read)
 
-    with pysam.AlignmentFile(bam_filename, 'rb', check_sq=False) as bam_file:
-        with pysam.AlignmentFile(analysis_name + '.intermediate.bam', 'wb', header=bam_file.header) as intermediate_file:
-            if whitelist_10x_filename:
-                whitelist_10x = read_barcodes(whitelist_10x_filename)
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def concatenate(filenames, output_filename):
+        """
+        Concatenates intermediate files in the given order without recompressing them
+        """
+        pysam.cat('-o', output_filename, *filenames)
+
+
+class AnnotationSpoolWriter:
+    """
+    Writes a compact record of the annotations of each read to a text file instead of writing the reads themselves. Each line
+    holds an adapter flag ("+" if the adapter was found), the raw barcode, and the UMI, with "." for missing values. The lines
+    are in the order of the reads in the input file, so the annotations can be applied in a single pass over the input file.
+    """
+    def __init__(self, filename, header=None, compression_level=None, io_threads=1):
+        self.file = open(filename, 'w')
+
+    def write(self, read, adapter, barcode, umi):
+        self.file.write('{}\t{}\t{}\n'.format(ANNOTATION_ADAPTER_FOUND if adapter is not None else '.',
+                                              barcode if barcode is not None else '.',
+                                              umi if umi is not None else '.'))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def concatenate(filenames, output_filename):
+        """
+        Concatenates spool files in the given order
+        """
+        with open(output_filename, 'wb') as output_file:
+            for filename in filenames:
+                with open(filename, 'rb') as spool_file:
+                    shutil.copyfileobj(spool_file, output_file)
+
+
+def read_annotation_spool(bam_file, annotations_filename, adapter_sequence, regions=None):
+    """
+    Yields the reads of a BAM file with the adapter, raw barcode, and UMI tags set from an annotation spool file written by
+    AnnotationSpoolWriter. Stops when the spool file is exhausted, i.e. after the last read that was annotated.
+    :param bam_file: The open reads BAM file
+    :param annotations_filename: Filename of the annotation spool file
+    :param adapter_sequence: The adapter sequence
+    :param regions: The regions the reads were annotated from. Can be None if all reads of the file were annotated.
+    :return: Generator of the annotated read objects
+    """
+    with open(annotations_filename) as annotations_file:
+        for read in fetch_reads(bam_file, regions):
+            line = annotations_file.readline()
+            if not line:
+                break
+            adapter_flag, barcode, umi = line[:-1].split('\t')
+            read.set_tag(ADAPTER_TAG, adapter_sequence if adapter_flag == ANNOTATION_ADAPTER_FOUND else ".", value_type='Z')
+            read.set_tag(RAW_BARCODE_TAG, barcode, value_type='Z')
+            read.set_tag(UMI_TAG, umi, value_type='Z')
+            yield read
+
+
+def count_observation(observed_barcodes, observed_barcodes_umis, barcode, umi):
+    """
+    Adds the barcode and UMI of a read to the observation counts
+    :param observed_barcodes: dict of observed barcodes with the barcode sequences as keys and the number of observations as values
+    :param observed_barcodes_umis: BarcodeUmiCounter of observed (barcode, UMI) pairs. Can be None if UMIs are not recorded
+    :param barcode: The raw barcode of the read. Can be None
+    :param umi: The raw UMI of the read. Can be None
+    """
+    if barcode is None:
+        return
+    observed_barcodes[barcode] = observed_barcodes.get(barcode, 0) + 1
+    if umi is not None and observed_barcodes_umis is not None:
+        observed_barcodes_umis.add(barcode, umi)
+
+
+class BarcodeUmiCounter:
+    """
+    Counts the observations of (barcode, UMI) pairs. Each pair is packed with 2 bits per base into a single uint64 key, and the
+    counts are kept in numpy runs of (key, count, first observation) entries that are sorted by key, i.e. 20 bytes per unique pair.
+    Observations are buffered and sorted into a new run when the buffer is full. The runs are merged when there are too many of them,
+    and a merged run with more than COUNTER_SPILL_ENTRIES entries is spilled to a file in the spill directory. Pairs that can not be
+    packed, i.e. that contain letters other than A, C, G, and T, are counted in a dict.
+    items() returns the pairs in the order of their first observation, the same order as a dict of the pairs.
+    """
+    # Translates a barcode and UMI into a base-4 number string for int(). Other letters are left as they are and make int() fail.
+    DIGITS = str.maketrans('ACGT', '0123')
+    ENTRY_DTYPE = np.dtype([('key', np.uint64), ('count', np.uint32), ('first_observation', np.uint64)])
+    ITEMS_CHUNK_SIZE = 1 << 16
+
+    def __init__(self, spill_directory='.'):
+        """
+        :param spill_directory: Directory for the files of spilled runs
+        """
+        self.spill_directory = spill_directory
+        self.observations = 0
+        self._buffer = []
+        self._buffer_start = 0
+        self._buffer_gaps = []
+        self._runs = []
+        self._spilled_runs = []
+        self._unpackable = dict()
+
+    def add(self, barcode, umi):
+        """
+        Counts an observation of a (barcode, UMI) pair
+        """
+        try:
+            if len(barcode) != BARCODE_LENGTH or len(umi) != UMI_LENGTH:
+                raise ValueError
+            self._buffer.append(int((barcode + umi).translate(BarcodeUmiCounter.DIGITS), 4))
+        except ValueError:
+            # The buffered observations after this one are numbered one higher
+            self._buffer_gaps.append(len(self._buffer))
+            if (barcode, umi) in self._unpackable:
+                self._unpackable[(barcode, umi)][1] += 1
             else:
-                whitelist_10x = None
+                self._unpackable[(barcode, umi)] = [self.observations, 1]
+        self.observations += 1
+
+        if len(self._buffer) >= COUNTER_BUFFER_SIZE:
+            self._flush()
+
+    def merge(self, other):
+        """
+        Adds the counts of another BarcodeUmiCounter, e.g. one of a worker process, whose observations come after the observations of this counter
+        :param other: The BarcodeUmiCounter to add. It can not be used anymore afterwards.
+        """
+        self._flush()
+        other._flush()
+        for run in other._runs:
+            run['first_observation'] += self.observations
+            self._add_run(run)
+        for spill_filename, observation_offset in other._spilled_runs:
+            self._spilled_runs.append((spill_filename, observation_offset + self.observations))
+        for pair, (first_observation, count) in other._unpackable.items():
+            if pair in self._unpackable:
+                self._unpackable[pair][1] += count
+            else:
+                self._unpackable[pair] = [first_observation + self.observations, count]
+        self.observations += other.observations
+        self._buffer_start = self.observations
+        other._runs = []
+        other._spilled_runs = []
+
+    def items(self):
+        """
+        Generates the counted pairs in the order of their first observation
+        :return: Generator of ((barcode, UMI), number of observations) tuples
+        """
+        self._flush()
+        if not self._spilled_runs:
+            run = self._merge_runs(self._runs)
+            streams = [BarcodeUmiCounter._iterate_run(run[np.argsort(run['first_observation'])], 0)]
+        else:
+            if self._runs:
+                self._spill(self._merge_runs(self._runs))
+                self._runs = []
+            streams = [BarcodeUmiCounter._iterate_run(partition, 0) for partition in self._partition_spilled_runs()]
+
+        unpackable = sorted((first_observation, pair, count) for pair, (first_observation, count) in self._unpackable.items())
+        streams.append(iter(unpackable))
+
+        for _, pair, count in heapq.merge(*streams):
+            yield pair, count
+
+    def close(self):
+        """
+        Removes the files of the spilled runs
+        """
+        for spill_filename, _ in self._spilled_runs:
+            if os.path.exists(spill_filename):
+                os.remove(spill_filename)
+        self._spilled_runs = []
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+    def _flush(self):
+        """
+        Sorts the buffered observations into a new run
+        """
+        if self._buffer:
+            buffer_indices = np.arange(len(self._buffer), dtype=np.uint64)
+            entries = np.empty(len(self._buffer), dtype=BarcodeUmiCounter.ENTRY_DTYPE)
+            entries['key'] = np.array(self._buffer, dtype=np.uint64)
+            entries['count'] = 1
+            entries['first_observation'] = self._buffer_start + buffer_indices + np.searchsorted(np.array(self._buffer_gaps, dtype=np.uint64), buffer_indices, side='right')
+            self._add_run(BarcodeUmiCounter._reduce(entries))
+        self._buffer = []
+        self._buffer_gaps = []
+        self._buffer_start = self.observations
+
+    def _add_run(self, run):
+        self._runs.append(run)
+        if len(self._runs) >= COUNTER_MAX_RUNS:
+            merged_run = self._merge_runs(self._runs)
+            self._runs = []
+            if len(merged_run) > COUNTER_SPILL_ENTRIES:
+                self._spill(merged_run)
+            else:
+                self._runs.append(merged_run)
+
+    def _spill(self, run):
+        spill_file, spill_filename = tempfile.mkstemp(prefix='umi_counts.', suffix='.npy', dir=self.spill_directory)
+        with os.fdopen(spill_file, 'wb') as spill_file:
+            np.save(spill_file, run)
+        self._spilled_runs.append((spill_filename, 0))
+
+    @staticmethod
+    def _merge_runs(runs):
+        if not runs:
+            return np.empty(0, dtype=BarcodeUmiCounter.ENTRY_DTYPE)
+        return BarcodeUmiCounter._reduce(np.concatenate(runs))
+
+    @staticmethod
+    def _reduce(entries):
+        """
+        Sorts entries by key and combines the entries of the same key
+        """
+        if len(entries) == 0:
+            return entries
+        entries = entries[np.argsort(entries['key'])]
+        keys = entries['key']
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        run = np.empty(len(starts), dtype=BarcodeUmiCounter.ENTRY_DTYPE)
+        run['key'] = keys[starts]
+        run['count'] = np.add.reduceat(entries['count'], starts)
+        run['first_observation'] = np.minimum.reduceat(entries['first_observation'], starts)
+        return run
+
+    def _partition_spilled_runs(self):
+        """
+        Splits the key space into one partition per spilled run and merges the entries of each partition, so that only one partition
+        at a time has to be held in memory
+        :return: List of the merged partitions, each sorted by first observation and memory-mapped from a file in the spill directory
+        """
+        spilled_runs = [(np.load(spill_filename, mmap_mode='r'), observation_offset) for spill_filename, observation_offset in self._spilled_runs]
+        boundaries = np.linspace(0, 4 ** (BARCODE_LENGTH + UMI_LENGTH), len(spilled_runs) + 1).astype(np.uint64)
+        boundaries[-1] = np.iinfo(np.uint64).max
+
+        partitions = []
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            pieces = []
+            for run, observation_offset in spilled_runs:
+                piece = np.array(run[np.searchsorted(run['key'], start):np.searchsorted(run['key'], end)])
+                piece['first_observation'] += observation_offset
+                pieces.append(piece)
+            partition = self._merge_runs(pieces)
+            partition = partition[np.argsort(partition['first_observation'])]
+
+            partition_file, partition_filename = tempfile.mkstemp(prefix='umi_counts.', suffix='.npy', dir=self.spill_directory)
+            with os.fdopen(partition_file, 'wb') as partition_file:
+                np.save(partition_file, partition)
+            partitions.append(np.load(partition_filename, mmap_mode='r'))
+            # The memory map keeps the data available after the file is removed
+            os.remove(partition_filename)
+        return partitions
+
+    @staticmethod
+    def _iterate_run(run, observation_offset):
+        """
+        Generates the entries of a run that is sorted by first observation
+        :return: Generator of (first observation, (barcode, UMI), count) tuples
+        """
+        for chunk_start in range(0, len(run), BarcodeUmiCounter.ITEMS_CHUNK_SIZE):
+            chunk = run[chunk_start:chunk_start + BarcodeUmiCounter.ITEMS_CHUNK_SIZE]
+            sequences = unpack_sequences(np.asarray(chunk['key']), BARCODE_LENGTH + UMI_LENGTH)
+            for first_observation, sequence, count in zip(chunk['first_observation'].tolist(), sequences, chunk['count'].tolist()):
+                yield first_observation + observation_offset, (sequence[:BARCODE_LENGTH], sequence[BARCODE_LENGTH:]), count
+
+
+def merge_counts(counts, other_counts):
+    """
+    Adds the observation counts of one dict to another
+    :param counts: dict of observation counts that is updated
+    :param other_counts: dict of observation counts to add
+    """
+    for key, occurrence in other_counts.items():
+        counts[key] = counts.get(key, 0) + occurrence
+
 
-            if whitelist_illumina_filename:
-                whitelist_illumina = read_barcodes(whitelist_illumina_filename)
+def compute_region_shards(bam_filename, regions, reads_done, max_reads):
+    """
+    Splits the reads of the given regions into one shard per region. The numbers of reads of whole contigs are taken from the BAM
+    index, so that the reads that were already annotated and the max_reads limit can be assigned to the regions without reading them.
+    :param bam_filename: Filename of the reads BAM file
+    :param regions: List of contig names or regions
+    :param reads_done: Number of reads of the regions that were already annotated
+    :param max_reads: Number of reads to process before stopping the processing. Can be None to process all reads of the regions.
+    :return: A list of (region, number of reads to skip, maximum number of reads, index of the first read in the regions) tuples, one for each shard. The maximum number of reads is None if all reads are annotated.
+    """
+    with pysam.AlignmentFile(bam_filename, 'rb') as bam_file:
+        region_reads = {contig_stats.contig: contig_stats.total for contig_stats in bam_file.get_index_statistics()}
+        region_reads['*'] = bam_file.nocoordinate
+
+    shards = []
+    remaining_reads = max_reads - reads_done if max_reads is not None else None
+    first_read = reads_done
+    for region in regions:
+        if remaining_reads is not None and remaining_reads <= 0:
+            break
+        reads_in_region = region_reads.get(region)
+        if reads_in_region is not None and reads_done >= reads_in_region:
+            reads_done -= reads_in_region
+            continue
+
+        shards.append((region, reads_done, remaining_reads, first_read))
+        if reads_in_region is None:
+            # Without the number of reads of the region, the following regions can not be assigned their reads
+            break
+        if remaining_reads is not None:
+            remaining_reads -= reads_in_region - reads_done
+        first_read += reads_in_region - reads_done
+        reads_done = 0
+    return shards
+
+
+def compute_shards(bam_filename, reads_per_shard, max_reads, start_offset=None, io_threads=1):
+    """
+    Splits the BAM file into shards of consecutive reads by recording the BGZF virtual offset of every reads_per_shard-th read.
+    The shards are generated while the file is read, so that the first shards can be annotated before the end of the file is reached.
+    :param bam_filename: Filename of the reads BAM file
+    :param reads_per_shard: Number of reads in each shard
+    :param max_reads: Number of reads to process before stopping the processing. Can be None to process the entire file.
+    :param start_offset: Virtual offset of the first read to split into shards. Can be None to start at the first read of the file.
+    :param io_threads: Number of threads used for decompressing the BAM file
+    :return: A generator of (virtual offset, number of reads, virtual offset after the last read) tuples, one for each shard
+    """
+    if max_reads == 0:
+        return
+    with pysam.AlignmentFile(bam_filename, 'rb', check_sq=False, threads=io_threads) as bam_file:
+        if start_offset is not None:
+            bam_file.seek(start_offset)
+        shard_offset = bam_file.tell()
+        reads_in_shard = 0
+        reads_seen = 0
+        for _ in bam_file.fetch(until_eof=True):
+            reads_seen += 1
+            reads_in_shard += 1
+            if reads_in_shard == reads_per_shard:
+                shard_end_offset = bam_file.tell()
+                yield shard_offset, reads_in_shard, shard_end_offset
+                shard_offset = shard_end_offset
+                reads_in_shard = 0
+            if max_reads is not None and reads_seen >= max_reads:
+                break
+        if reads_in_shard > 0:
+            yield shard_offset, reads_in_shard, bam_file.tell()
+
+
+def offset_shards(bam_filename, max_reads, start_offset, first_read, io_threads):
+    """
+    Generates the shard descriptions of annotate_shard() for the shards of consecutive reads of compute_shards()
+    :param bam_filename: Filename of the reads BAM file
+    :param max_reads: Number of reads to process before stopping the processing. Can be None to process the entire file.
+    :param start_offset: Virtual offset of the first read to split into shards. Can be None to start at the first read of the file.
+    :param first_read: Index of the read at start_offset in the input
+    :param io_threads: Number of threads used for decompressing the BAM file
+    :return: A generator of (None, virtual offset, 0, number of reads, index of the first read, virtual offset after the last read) tuples
+    """
+    for shard_offset, shard_reads, shard_end_offset in compute_shards(bam_filename, READS_PER_SHARD, max_reads, start_offset, io_threads):
+        yield None, shard_offset, 0, shard_reads, first_read, shard_end_offset
+        first_read += shard_reads
+
+
+# State of a worker process, set up once by init_worker() so that only the shard descriptions are sent to the workers
+_worker_state = dict()
+
+
+def init_worker(bam_filename, ssw_path, read_end_length, adapter_sequence, tso_sequence, whitelist_10x, whitelist_illumina, record_umis, writer_class, tso_sample_interval, intermediate_compression_level, io_threads, alignment_threads, alignment_engine):
+    """
+    Initializes a worker process for annotate_shard()
+    """
+    aligner = create_aligner(ssw_path, adapter_sequence, tso_sequence, tso_sample_interval, alignment_threads, alignment_engine)
+    _worker_state.update(bam_filename=bam_filename, aligner=aligner, read_end_length=read_end_length,
+                         whitelist_10x=whitelist_10x, whitelist_illumina=whitelist_illumina, record_umis=record_umis, writer_class=writer_class,
+                         intermediate_compression_level=intermediate_compression_level, io_threads=io_threads)
+
+
+def annotate_shard(shard):
+    """
+    Annotates the reads of one shard in a worker process and writes the annotations to a separate intermediate file
+    :param shard: Tuple of the region of the shard (None for a range of consecutive reads of the file), the virtual offset of the first read (None for a region), the number of reads to skip, the maximum number of reads (None for all reads of a region), the index of the first annotated read in the input, and the filename of the shard's intermediate file
+    :return: The AnalysisStats object, the observed barcodes, and the observed barcodes and UMIs (None if UMIs are not recorded) of the shard
+    """
+    shard_region, shard_offset, shard_skipped_reads, shard_reads, shard_first_read, shard_filename = shard
+    state = _worker_state
+
+    stats = AnalysisStats()
+    observed_barcodes = dict()
+    observed_barcodes_umis = BarcodeUmiCounter() if state['record_umis'] else None
+
+    with pysam.AlignmentFile(state['bam_filename'], 'rb', check_sq=False, threads=state['io_threads']) as bam_file:
+        with state['writer_class'](shard_filename, bam_file.header, state['intermediate_compression_level'], state['io_threads']) as shard_file:
+            if shard_region is None:
+                bam_file.seek(shard_offset)
+                shard_iterator = bam_file.fetch(until_eof=True)
             else:
-                whitelist_illumina = None
+                shard_iterator = bam_file.fetch(region=shard_region)
+            shard_end = shard_skipped_reads + shard_reads if shard_reads is not None else None
+            for reads in read_batches(itertools.islice(shard_iterator, shard_skipped_reads, shard_end), READS_PER_BATCH):
+                annotations = annotate_reads(reads, stats, state['aligner'], state['read_end_length'], state['whitelist_10x'], state['whitelist_illumina'], shard_first_read)
+                for read, (adapter, observed_barcode, observed_umi) in zip(reads, annotations):
+                    count_observation(observed_barcodes, observed_barcodes_umis, observed_barcode, observed_umi)
+                    shard_file.write(read, adapter, observed_barcode, observed_umi)
+
+    return stats, observed_barcodes, observed_barcodes_umis
+
+
+def finish_segments(segment_filenames, intermediate_filename, writer_class, bam_filename):
+    """
+    Concatenates the segment files of the intermediate file in input order and removes them
+    :param segment_filenames: Filenames of the segment files
+    :param intermediate_filename: Filename of the intermediate file
+    :param writer_class: IntermediateBamWriter or AnnotationSpoolWriter
+    :param bam_filename: Filename of the reads BAM file, whose header is used if there are no segments
+    """
+    if segment_filenames == [intermediate_filename]:
+        return
+    if segment_filenames:
+        writer_class.concatenate(segment_filenames, intermediate_filename)
+        for segment_filename in segment_filenames:
+            os.remove(segment_filename)
+    else:
+        with pysam.AlignmentFile(bam_filename, 'rb', check_sq=False) as bam_file:
+            writer_class(intermediate_filename, bam_file.header).close()
 
-            stats = AnalysisStats()
 
-            observed_barcodes = dict()
+def annotate_serial(bam_filename, intermediate_filename, writer_class, max_reads, ssw_path, read_end_length, adapter_sequence, tso_sequence, whitelist_10x, whitelist_illumina, progress_reporter_args, state, checkpoint=None, regions=None, tso_sample_interval=1, intermediate_compression_level=None, io_threads=1, alignment_threads=1, alignment_engine='ssw'):
+    """
+    Annotates the reads in a single process. Without a checkpoint, the annotations are written directly to the intermediate file.
+    With a checkpoint, a new segment file of the intermediate file is started at each checkpoint, and the annotation continues
+    from the input offset of the state, or after the annotated reads of the regions.
+    :param writer_class: IntermediateBamWriter or AnnotationSpoolWriter
+    :param progress_reporter_args: dict of keyword arguments for the ProgressReporter
+    :param state: The annotation state created by AnnotationCheckpoint.new_state() or loaded from a checkpoint, which is updated
+    :param checkpoint: The AnnotationCheckpoint object. Can be None to not save checkpoints.
+    :param regions: List of regions to annotate the reads of. Can be None to annotate all reads of the file.
+    :param tso_sample_interval: Interval of the reads that are aligned to the TSO sequence. 0 to align no read to the TSO sequence.
+    :param intermediate_compression_level: BGZF compression level of the intermediate BAM file. Can be None to use the htslib default.
+    :param io_threads: Number of threads used for decompressing the BAM file and compressing the intermediate BAM file
+    :param alignment_threads: Number of threads used for aligning the read ends, in each process
+    :param alignment_engine: 'ssw' to align the read ends with the ssw library, 'numpy' to align them with ssw_lib.NumpySsw
+    """
+    stats, observed_barcodes, observed_barcodes_umis = state['stats'], state['observed_barcodes'], state['observed_barcodes_umis']
+    segment_filenames = state['segment_filenames']
+    remaining_reads = max(max_reads - stats.reads_seen, 0) if max_reads is not None else None
+
+    def next_segment_filename():
+        return intermediate_filename if checkpoint is None else '{}.part{}'.format(intermediate_filename, len(segment_filenames))
+
+    with create_aligner(ssw_path, adapter_sequence, tso_sequence, tso_sample_interval, alignment_threads, alignment_engine) as aligner:
+        with pysam.AlignmentFile(bam_filename, 'rb', check_sq=False, threads=io_threads) as bam_file:
+            if regions is not None:
+                # The reads of regions can not be resumed from an offset, so the reads that were already annotated are skipped
+                reads_iterator = itertools.islice(fetch_reads(bam_file, regions), stats.reads_seen, None)
+            else:
+                if state['input_offset'] is not None:
+                    bam_file.seek(state['input_offset'])
+                reads_iterator = bam_file.fetch(until_eof=True)
+
+            # The upper bits of the virtual offset are the offset in the compressed file
+            bam_file_size = os.path.getsize(bam_filename)
+            progress_reporter = ProgressReporter('Annotation', total_reads=max_reads, stats=stats, start_reads=stats.reads_seen,
+                                                 start_fraction=(bam_file.tell() >> 16) / bam_file_size, tso_sample_interval=tso_sample_interval, **progress_reporter_args)
+
+            segment_filename = next_segment_filename()
+            segment_file = writer_class(segment_filename, bam_file.header, intermediate_compression_level, io_threads)
+            try:
+                for reads in read_batches(itertools.islice(reads_iterator, remaining_reads), READS_PER_BATCH):
+                    annotations = annotate_reads(reads, stats, aligner, read_end_length, whitelist_10x, whitelist_illumina)
+                    for read, (adapter, observed_barcode, observed_umi) in zip(reads, annotations):
+                        count_observation(observed_barcodes, observed_barcodes_umis, observed_barcode, observed_umi)
+                        segment_file.write(read, adapter, observed_barcode, observed_umi)
+
+                    progress_reporter.update(stats.reads_seen, (bam_file.tell() >> 16) / bam_file_size)
+
+                    if checkpoint is not None and checkpoint.due():
+                        segment_file.close()
+                        segment_filenames.append(segment_filename)
+                        state['input_offset'] = bam_file.tell()
+                        checkpoint.save(state)
+                        segment_filename = next_segment_filename()
+                        segment_file = writer_class(segment_filename, bam_file.header, intermediate_compression_level, io_threads)
+            finally:
+                segment_file.close()
+            segment_filenames.append(segment_filename)
+            state['input_offset'] = bam_file.tell()
+            progress_reporter.finish(stats.reads_seen)
+
+    finish_segments(segment_filenames, intermediate_filename, writer_class, bam_filename)
+
+
+def annotate_parallel(bam_filename, intermediate_filename, writer_class, threads, max_reads, ssw_path, read_end_length, adapter_sequence, tso_sequence, whitelist_10x, whitelist_illumina, record_umis, progress_reporter_args, state, checkpoint=None, regions=None, tso_sample_interval=1, intermediate_compression_level=None, io_threads=1, alignment_threads=1, alignment_engine='ssw'):
+    """
+    Annotates the reads using multiple worker processes. The input is split into shards of consecutive reads, or into one shard per
+    region if regions are given, each of which is annotated into a separate segment file. The shards of consecutive reads are found
+    by the task handler thread of the pool while the workers annotate the shards found before. The segment files are concatenated in
+    input order, so the intermediate file and the counts are the same as when annotating in a single process. With a checkpoint, the
+    annotation continues from the input offset of the state, or after the annotated reads of the regions, and the state is saved
+    after a finished shard once the checkpoint is due.
+    :param writer_class: IntermediateBamWriter or AnnotationSpoolWriter
+    :param progress_reporter_args: dict of keyword arguments for the ProgressReporter
+    :param state: The annotation state created by AnnotationCheckpoint.new_state() or loaded from a checkpoint, which is updated
+    :param checkpoint: The AnnotationCheckpoint object. Can be None to not save checkpoints.
+    :param regions: List of regions to annotate the reads of. Can be None to annotate all reads of the file.
+    :param tso_sample_interval: Interval of the reads that are aligned to the TSO sequence. 0 to align no read to the TSO sequence.
+    :param intermediate_compression_level: BGZF compression level of the intermediate BAM file. Can be None to use the htslib default.
+    :param io_threads: Number of threads used for decompressing the BAM file and compressing the intermediate BAM file
+    :param alignment_threads: Number of threads used for aligning the read ends, in each process
+    :param alignment_engine: 'ssw' to align the read ends with the ssw library, 'numpy' to align them with ssw_lib.NumpySsw
+    """
+    stats, observed_barcodes, observed_barcodes_umis = state['stats'], state['observed_barcodes'], state['observed_barcodes_umis']
+    segment_filenames = state['segment_filenames']
+    remaining_reads = max(max_reads - stats.reads_seen, 0) if max_reads is not None else None
+
+    # The upper bits of the virtual offset are the offset in the compressed file
+    bam_file_size = os.path.getsize(bam_filename)
+    if regions is not None:
+        shards = [(shard_region, None, shard_skipped_reads, shard_reads, shard_first_read, None)
+                  for shard_region, shard_skipped_reads, shard_reads, shard_first_read in compute_region_shards(bam_filename, regions, stats.reads_seen, max_reads)]
+        start_fraction = 0.0
+    else:
+        shards = offset_shards(bam_filename, remaining_reads, state['input_offset'], stats.reads_seen, io_threads)
+        start_fraction = (state['input_offset'] >> 16) / bam_file_size if state['input_offset'] is not None else 0.0
+    first_segment = len(segment_filenames)
+    shard_end_offsets = []
+
+    def shard_tasks():
+        # Runs in the task handler thread of the pool. The end offset of a shard is recorded before its task is dispatched, so it is
+        # known when the result of the shard arrives.
+        for i, (shard_region, shard_offset, shard_skipped_reads, shard_reads, shard_first_read, shard_end_offset) in enumerate(shards):
+            shard_end_offsets.append(shard_end_offset)
+            yield shard_region, shard_offset, shard_skipped_reads, shard_reads, shard_first_read, '{}.part{}'.format(intermediate_filename, first_segment + i)
+
+    print('Annotating shards of {:,} reads using {} processes...'.format(READS_PER_SHARD, threads))
+
+    progress_reporter = ProgressReporter('Annotation', total_reads=max_reads, stats=stats, start_reads=stats.reads_seen, start_fraction=start_fraction,
+                                         tso_sample_interval=tso_sample_interval, **progress_reporter_args)
+    with multiprocessing.Pool(threads, initializer=init_worker,
+                              initargs=(bam_filename, ssw_path, read_end_length, adapter_sequence, tso_sequence, whitelist_10x, whitelist_illumina, record_umis, writer_class, tso_sample_interval,
+                                        intermediate_compression_level, io_threads, alignment_threads, alignment_engine)) as pool:
+        for i, (shard_stats, shard_barcodes, shard_barcodes_umis) in enumerate(pool.imap(annotate_shard, shard_tasks())):
+            stats.merge(shard_stats)
+            merge_counts(observed_barcodes, shard_barcodes)
             if record_umis:
-                observed_barcodes_umis = dict()
+                observed_barcodes_umis.merge(shard_barcodes_umis)
+            segment_filenames.append('{}.part{}'.format(intermediate_filename, first_segment + i))
+
+            shard_end_offset = shard_end_offsets[i]
+            progress_reporter.update(stats.reads_seen, (shard_end_offset >> 16) / bam_file_size if shard_end_offset is not None else None)
 
-            last_timing = time.time()
-            reads_seen = 0
+            if checkpoint is not None and checkpoint.due():
+                state['input_offset'] = shard_end_offset
+                checkpoint.save(state)
+    progress_reporter.finish(stats.reads_seen)
 
-            for read in bam_file.fetch(until_eof=True):
-                reads_seen += 1
+    finish_segments(segment_filenames, intermediate_filename, writer_class, bam_filename)
 
-                if reads_seen % 1000 == 0:
-                    current_time = time.time()
-                    print('Processed reads: {:,}. Time elapsed: {:.2f}s'.format(reads_seen, current_time - last_timing))
-                    last_timing = current_time
 
-                if max_reads is not None and reads_seen > max_reads:
+def substitution_masks(length, max_distance):
+    """
+    Builds the XOR masks that turn a 2-bit packed sequence into all sequences with between 1 and max_distance substitutions
+    :param length: Length of the sequences
+    :param max_distance: Maximum number of substitutions
+    :return: A numpy uint64 array of masks and a numpy array with the number of substitutions of each mask
+    """
+    masks = []
+    distances = []
+    for distance in range(1, max_distance + 1):
+        for positions in itertools.combinations(range(length), distance):
+            for substitutions in itertools.product((1, 2, 3), repeat=distance):
+                mask = 0
+                for position, substitution in zip(positions, substitutions):
+                    mask |= substitution << (2 * (length - 1 - position))
+                masks.append(mask)
+                distances.append(distance)
+    return np.array(masks, dtype=np.uint64), np.array(distances, dtype=np.int64)
+
+
+def perform_barcode_correction_native(observed_barcodes, analysis_name, stats=None, max_distance=2, cluster_ratio=5):
+    """
+    Performs the barcode correction in-process by count-weighted clustering of the 2-bit packed barcodes. A barcode is merged into
+    the most abundant barcode within max_distance substitutions that has been observed at least cluster_ratio times as often, and
+    clusters are merged transitively, similar to the message passing clustering of starcode. Neighbours are found by generating all
+    substitution variants of the barcodes that are abundant enough to absorb other barcodes and looking them up in the sorted array
+    of observed barcodes. The clusters are written in the format of the starcode output.
+    :param observed_barcodes: dict of observed barcodes with the barcode sequences as keys and the number of observations as values
+    :param analysis_name: Prefix for the stats files
+    :param stats: The AnalysisStats file
+    :param max_distance: Maximum Hamming distance between a barcode and the centroid it is corrected to
+    :param cluster_ratio: Minimum ratio between the number of observations of a barcode and a barcode merged into it
+    :return: A dictionary with the raw barcodes as keys and the corresponding corrected barcodes as values
+    """
+    barcodes = list(observed_barcodes.keys())
+    counts = np.array(list(observed_barcodes.values()), dtype=np.int64)
+    packed, valid = pack_sequences(barcodes, BARCODE_LENGTH)
+
+    # Sorted array of the packed barcodes for looking up neighbours. Barcodes that cannot be packed form their own clusters.
+    valid_indices = np.flatnonzero(valid)
+    order = valid_indices[np.argsort(packed[valid_indices], kind='stable')]
+    sorted_packed = packed[order]
+
+    parents = np.arange(len(barcodes))
+    if len(order) > 0:
+        masks, mask_distances = substitution_masks(BARCODE_LENGTH, max_distance)
+        candidate_parents = order[counts[order] >= cluster_ratio]
+
+        child_indices, parent_indices, distances = [], [], []
+        block_size = max(1, 4000000 // len(masks))
+        for block_start in range(0, len(candidate_parents), block_size):
+            block = candidate_parents[block_start:block_start + block_size]
+            neighbours = packed[block][:, np.newaxis] ^ masks[np.newaxis, :]
+            positions = np.minimum(np.searchsorted(sorted_packed, neighbours), len(sorted_packed) - 1)
+            block_index, mask_index = np.nonzero(sorted_packed[positions] == neighbours)
+            children = order[positions[block_index, mask_index]]
+            block_parents = block[block_index]
+            absorbed = counts[block_parents] >= cluster_ratio * counts[children]
+            child_indices.append(children[absorbed])
+            parent_indices.append(block_parents[absorbed])
+            distances.append(mask_distances[mask_index[absorbed]])
+
+        if child_indices:
+            child_indices = np.concatenate(child_indices)
+            parent_indices = np.concatenate(parent_indices)
+            distances = np.concatenate(distances)
+
+            # For each barcode, pick the most abundant neighbour, then the closest one, then the smallest packed sequence
+            best = np.lexsort((packed[parent_indices], distances, -counts[parent_indices], child_indices))
+            child_indices, parent_indices = child_indices[best], parent_indices[best]
+            first = np.ones(len(child_indices), dtype=bool)
+            first[1:] = child_indices[1:] != child_indices[:-1]
+            parents[child_indices[first]] = parent_indices[first]
+
+            # Merge clusters transitively. Parents are more abundant than their children, so this terminates.
+            while True:
+                grandparents = parents[parents]
+                if np.array_equal(grandparents, parents):
                     break
+                parents = grandparents
 
-                stats.reads_seen += 1
+    clusters = dict()
+    for index in sorted(range(len(barcodes)), key=lambda index: (-counts[index], barcodes[index])):
+        clusters.setdefault(parents[index], []).append(index)
+    cluster_counts = {centroid: int(counts[members].sum()) for centroid, members in clusters.items()}
 
-                sequence, adapter_alignment_end = align(read, stats, ssw, alphabet, letter_to_int, mat, read_end_length, adapter_sequence, tso_sequence)
+    correction_dict = dict()
+    starcode_output_file = open(analysis_name + '_starcode.tsv', 'w') if analysis_name is not None else None
+    if starcode_output_file is not None:
+        starcode_output_file.write('cluster\toccurrence\tindices\n')
+
+    for centroid in sorted(clusters, key=lambda centroid: (-cluster_counts[centroid], barcodes[centroid])):
+        cluster_sequences = [barcodes[member] for member in clusters[centroid]]
+        for cluster_sequence in cluster_sequences:
+            correction_dict[cluster_sequence] = barcodes[centroid]
+        if starcode_output_file is not None:
+            starcode_output_file.write('{}\t{}\t{}\n'.format(barcodes[centroid], cluster_counts[centroid], ','.join(cluster_sequences)))
+    if starcode_output_file is not None:
+        starcode_output_file.close()
+
+    if stats is not None:
+        stats.starcode_clusters = len(clusters)
 
-                if sequence is None or adapter_alignment_end is None:
-                    read.set_tag(ADAPTER_TAG, ".", value_type='Z')
-                    read.set_tag(RAW_BARCODE_TAG, ".", value_type='Z')
-                    read.set_tag(UMI_TAG, ".", value_type='Z')
-                    intermediate_file.write(read)
+    return correction_dict
 
-                    continue
 
-                # Barcode
-                observed_barcode, observed_barcode_position, observed_barcode_in_10x, observed_barcode_in_illumina = process_barcode(sequence, adapter_alignment_end, stats, whitelist_10x, whitelist_illumina)
-                if observed_barcode is None:
-                    read.set_tag(ADAPTER_TAG, adapter_sequence, value_type='Z')
-                    read.set_tag(RAW_BARCODE_TAG, ".", value_type='Z')
-                    read.set_tag(UMI_TAG, ".", value_type='Z')
-                    intermediate_file.write(read)
+def main(bam_filename, analysis_name, adapter_fasta_filename, tso_fasta_filename, whitelist_10x_filename, whitelist_illumina_filename, max_reads, contig, read_end_length, record_umis, ssw_path, starcode_path, threads=1, intermediate_bam=True, barcode_corrector='starcode', starcode_counted_input=False, progress_interval=PROGRESS_INTERVAL_SECONDS, progress_filename=None, checkpoint_interval=None, scatter_contigs=False, tso_sample_interval=1, io_threads=1, intermediate_compression_level=None, fastq=False, alignment_threads=1, alignment_engine='ssw', output_threads=None):
+    """
+    Main function for the tool
+    :param bam_filename: Filename of the reads BAM file
+    :param analysis_name: Prefix for storing the analysis stats files
+    :param adapter_fasta_filename: Filename for the FASTA file of the adapter sequence
+    :param tso_fasta_filename: Filename for the FASTA file of the TSO sequence
+    :param whitelist_10x_filename: Filename of the 10x whitelist. Can be None or empty, unless whitelist_illumina_filename is None or empty
+    :param whitelist_illumina_filename: Filename of the Illumina whitelist. Can be None or empty
+    :param max_reads: Number of reads to process before stopping the processing. Can be None to process the entire file.
+    :param contig: Contig name or region (chr:start-end) to limit the processing to, using the BAM index. Can be None to process all contigs.
+    :param read_end_length: Number of bases to look for the adapter, barcode, UMI, and poly-T tail in both ends of each read. Recommendatios for {PacBio: 80, Oxford Nanopore: 250)
+    :param record_umis: Whether or not to store the UMIs in a separate file
+    :param ssw_path: Path to the ssw library
+    :param starcode_path: Path to the starcode executable
+    :param threads: Number of processes to annotate the reads with
+    :param intermediate_bam: Whether to write the annotated reads to an intermediate BAM file. If False, only a compact record of the annotations is stored and the tags are added in a single pass over the input BAM file after barcode correction.
+    :param barcode_corrector: 'starcode' to correct the barcodes with the starcode executable, 'native' to use perform_barcode_correction_native
+    :param starcode_counted_input: Whether to pass each unique barcode to starcode once together with its number of observations
+    :param progress_interval: Minimum number of seconds between progress reports
+    :param progress_filename: Filename of a JSON file that is replaced with the current progress at each report. Can be None.
+    :param checkpoint_interval: Minimum number of seconds between checkpoints of the annotation, which are resumed when the tool is restarted with the same arguments. Can be None to not save checkpoints.
+    :param scatter_contigs: Whether to annotate each contig of the indexed BAM file, and the unmapped reads without a position, as a separate shard. With more than one thread, the contigs are annotated in parallel.
+    :param tso_sample_interval: Interval of the reads that are aligned to the TSO sequence. The TSO counts of the stats are extrapolated from these reads. 0 to align no read to the TSO sequence, which leaves the TSO counts at 0.
+    :param io_threads: Number of threads used for the BGZF compression and decompression of each BAM file that is read or written by each annotating process
+    :param intermediate_compression_level: BGZF compression level of the intermediate BAM file, from 0 (uncompressed) to 9. Can be None to use the htslib default.
+    :param fastq: Whether to also write the annotated reads to a gzip compressed FASTQ file, in the pass that writes the output BAM file
+    :param alignment_threads: Number of threads used for aligning the read ends in each annotating process
+    :param alignment_engine: 'ssw' to align the read ends with the ssw library, 'numpy' to align them with ssw_lib.NumpySsw, which gives the same results
+    :param output_threads: Number of threads used for reading and writing the BAM files and compressing the FASTQ file in the barcode correction pass, which runs in a single process. Can be None to use the larger of threads and io_threads.
+    """
+    if output_threads is None:
+        output_threads = max(threads, io_threads)
 
-                    continue
+    with pysam.FastaFile(adapter_fasta_filename) as adapter_fasta_file:
+        adapter_sequence = adapter_fasta_file.fetch(reference='adapter_sequence')
+    with pysam.FastaFile(tso_fasta_filename) as tso_fasta_file:
+        tso_sequence = tso_fasta_file.fetch(reference='adapter_sequence')
 
-                observed_barcodes[observed_barcode] = observed_barcodes.get(observed_barcode, 0) + 1
+    if whitelist_10x_filename:
+        whitelist_10x = read_barcodes(whitelist_10x_filename)
+    else:
+        whitelist_10x = None
 
-                # UMI
-                observed_umi, observed_umi_position = process_umi(sequence, observed_barcode_position, stats)
-                if observed_umi is None:
-                    read.set_tag(ADAPTER_TAG, adapter_sequence, value_type='Z')
-                    read.set_tag(RAW_BARCODE_TAG, observed_barcode, value_type='Z')
-                    read.set_tag(UMI_TAG, ".", value_type='Z')
-                    intermediate_file.write(read)
+    if whitelist_illumina_filename:
+        whitelist_illumina = read_barcodes(whitelist_illumina_filename)
+    else:
+        whitelist_illumina = None
 
-                    continue
+    if intermediate_bam:
+        intermediate_filename = analysis_name + '.intermediate.bam'
+        writer_class = IntermediateBamWriter
+    else:
+        intermediate_filename = analysis_name + '.annotations.tsv'
+        writer_class = AnnotationSpoolWriter
 
-                # Poly-T
-                poly_t_found = process_poly_t(sequence, observed_umi_position, stats)
-                if not poly_t_found:
-                    pass
+    if contig:
+        regions = [contig]
+    elif scatter_contigs:
+        regions = list_contig_regions(bam_filename)
+    else:
+        regions = None
+
+    # Snapshots of the stats are written to a separate file while processing, which is removed when the final stats are written
+    partial_stats_filename = '{}_stats.partial.tsv'.format(analysis_name) if analysis_name else None
+    progress_reporter_args = dict(interval=progress_interval, progress_filename=progress_filename, stats_filename=partial_stats_filename)
+
+    if checkpoint_interval:
+        settings = dict(bam_filename=os.path.abspath(bam_filename), bam_size=os.path.getsize(bam_filename), intermediate_filename=intermediate_filename, max_reads=max_reads,
+                        regions=regions, read_end_length=read_end_length, record_umis=record_umis, adapter_sequence=adapter_sequence, tso_sequence=tso_sequence,
+                        whitelist_10x_filename=whitelist_10x_filename, whitelist_illumina_filename=whitelist_illumina_filename, tso_sample_interval=tso_sample_interval)
+        checkpoint = AnnotationCheckpoint(analysis_name + '.checkpoint', checkpoint_interval, settings)
+        state = checkpoint.load()
+    else:
+        checkpoint = None
+        state = None
 
-                observed_barcodes_umis[(observed_barcode, observed_umi)] = observed_barcodes_umis.get((observed_barcode, observed_umi), 0) + 1
+    if state is None:
+        state = AnnotationCheckpoint.new_state(record_umis)
+    elif state['annotation_complete']:
+        print('Resuming from checkpoint after the annotation of {:,} reads'.format(state['stats'].reads_seen))
+    else:
+        print('Resuming from checkpoint after {:,} reads'.format(state['stats'].reads_seen))
 
-                read.set_tag(ADAPTER_TAG, adapter_sequence, value_type='Z')
-                read.set_tag(RAW_BARCODE_TAG, observed_barcode, value_type='Z')
-                read.set_tag(UMI_TAG, observed_umi, value_type='Z')
-                intermediate_file.write(read)
+    if not state['annotation_complete']:
+        if threads > 1:
+            annotate_parallel(bam_filename, intermediate_filename, writer_class, threads, max_reads, ssw_path, read_end_length,
+                              adapter_sequence, tso_sequence, whitelist_10x, whitelist_illumina, record_umis, progress_reporter_args, state, checkpoint, regions, tso_sample_interval,
+                              intermediate_compression_level, io_threads, alignment_threads, alignment_engine)
+        else:
+            annotate_serial(bam_filename, intermediate_filename, writer_class, max_reads, ssw_path, read_end_length,
+                            adapter_sequence, tso_sequence, whitelist_10x, whitelist_illumina, progress_reporter_args, state, checkpoint, regions, tso_sample_interval,
+                            intermediate_compression_level, io_threads, alignment_threads, alignment_engine)
+        state['annotation_complete'] = True
+        if checkpoint is not None:
+            checkpoint.save(state)
+
+    stats, observed_barcodes, observed_barcodes_umis = state['stats'], state['observed_barcodes'], state['observed_barcodes_umis']
+    print('Alignments skipped for exact adapter and TSO occurrences: {:,}'.format(stats.alignments_skipped))
+    if tso_sample_interval > 1:
+        stats.extrapolate_tso_counts(tso_sample_interval)
 
     print('Performing barcode corrections...')
 
-    correct_barcodes(observed_barcodes, analysis_name, stats, whitelist_10x, whitelist_illumina, starcode_path)
+    fastq_filename = analysis_name + '.fastq.gz' if fastq else None
+    if intermediate_bam:
+        correct_barcodes(observed_barcodes, analysis_name, stats, whitelist_10x, whitelist_illumina, starcode_path, barcode_corrector=barcode_corrector, starcode_counted_input=starcode_counted_input,
+                         progress_reporter_args=progress_reporter_args, io_threads=output_threads, fastq_filename=fastq_filename)
+    else:
+        correct_barcodes(observed_barcodes, analysis_name, stats, whitelist_10x, whitelist_illumina, starcode_path,
+                         input_filename=bam_filename, annotations_filename=intermediate_filename, adapter_sequence=adapter_sequence, barcode_corrector=barcode_corrector, starcode_counted_input=starcode_counted_input,
+                         progress_reporter_args=progress_reporter_args, regions=regions, io_threads=output_threads, fastq_filename=fastq_filename)
 
     if analysis_name:
         if record_umis:
@@ -569,69 +2081,229 @@ def main(bam_filename, analysis_name, adapter_fasta_filename, tso_fasta_filename
                     'barcode\tumi\toccurrence\n')
                 for ((barcode, umi), occurrence) in observed_barcodes_umis.items():
                     barcode_stats.write('{}\t{}\t{}\n'.format(barcode, umi, int(occurrence)))
+            observed_barcodes_umis.close()
 
-        with open('{}_stats.tsv'.format(analysis_name), 'w') as stats_file:
-            stats_file.write(AnalysisStats.print_header)
-            stats_file.write(stats.print_string())
+        stats.write('{}_stats.tsv'.format(analysis_name))
+        if os.path.exists(partial_stats_filename):
+            os.remove(partial_stats_filename)
+
+    if checkpoint is not None:
+        checkpoint.remove()
 
 
-def correct_barcodes(observed_barcodes, analysis_name, stats, whitelist_10x, whitelist_illumina, starcode_path):
+def correct_barcodes(observed_barcodes, analysis_name, stats, whitelist_10x, whitelist_illumina, starcode_path, input_filename=None, annotations_filename=None, adapter_sequence=None, barcode_corrector='starcode', starcode_counted_input=False, progress_reporter_args=None, regions=None, io_threads=1, fastq_filename=None):
     """
-    Performs correction of the observed barcodes and annotates the intermediate file accordingly
+    Performs correction of the observed barcodes and annotates the intermediate file accordingly. If an annotation spool file is
+    given, the reads are instead taken from the input BAM file and all tags are added in this pass.
     :param observed_barcodes: A dict with the observed barcode sequences as keys and the number of observations as values
     :param analysis_name: Prefix for storing the analysis stats files
     :param stats: The AnalysisStats object
     :param whitelist_10x: The 10x whitelist. Can be None or empty, unless whitelist_illumina_filename is None or empty
     :param whitelist_illumina: The Illumina whitelist. Can be None or empty
     :param starcode_path: Path to the starcode executable
+    :param input_filename: Filename of the BAM file to read the reads from. If None, the intermediate file is used.
+    :param annotations_filename: Filename of the annotation spool file written by AnnotationSpoolWriter. Can be None if the reads are taken from the intermediate file.
+    :param adapter_sequence: The adapter sequence. Only needed with an annotation spool file.
+    :param barcode_corrector: 'starcode' to correct the barcodes with the starcode executable, 'native' to use perform_barcode_correction_native
+    :param starcode_counted_input: Whether to pass each unique barcode to starcode once together with its number of observations
+    :param progress_reporter_args: dict of keyword arguments for the ProgressReporter. Can be None to use the defaults.
+    :param regions: The regions the reads were annotated from. Only needed with an annotation spool file.
+    :param io_threads: Number of threads used for decompressing the input file, compressing the output BAM file, and compressing the FASTQ file
+    :param fastq_filename: Filename of the gzip compressed FASTQ file that the reads are also written to. Can be None to only write the BAM file.
     """
     #subprocess.check_call(["/opt/conda/envs/10x_tool/bin/samtools", "index", analysis_name + '.intermediate.bam'])
 
-    correction_dict = perform_barcode_correction_starcode(observed_barcodes, analysis_name, starcode_path, stats)
+    if barcode_corrector == 'native':
+        correction_dict = perform_barcode_correction_native(observed_barcodes, analysis_name, stats)
+    else:
+        correction_dict = perform_barcode_correction_starcode(observed_barcodes, analysis_name, starcode_path, stats, starcode_counted_input)
     correction_dict['.'] = '.'
     print(len(correction_dict))
 
-    last_timing = time.time()
-    reads_in_intermediate_file = 0
+    write_corrected_reads(correction_dict, analysis_name, stats, whitelist_10x, whitelist_illumina, input_filename, annotations_filename,
+                          adapter_sequence, progress_reporter_args, regions, io_threads, fastq_filename)
 
-    with pysam.AlignmentFile(analysis_name + '.intermediate.bam', 'rb', check_sq=False) as bam_file:
-        with pysam.AlignmentFile(analysis_name + '.bam', 'wb', check_sq=False, header=bam_file.header) as output_file:
-            for read in bam_file.fetch(until_eof=True):
-                if reads_in_intermediate_file % 1000 == 0:
-                    current_time = time.time()
-                    print('Processed reads: {:,}. Time elapsed: {:.2f}s'.format(reads_in_intermediate_file, current_time - last_timing))
-                    last_timing = current_time
-
-                read.set_tag(BARCODE_TAG, read.get_tag(RAW_BARCODE_TAG), value_type='Z')
-
-                reads_in_intermediate_file += 1
-                raw_barcode = read.get_tag(RAW_BARCODE_TAG)
-                corrected_barcode = correction_dict[raw_barcode]
-                if raw_barcode == corrected_barcode:
-                    stats.barcode_not_corrected += 1
-                else:
-                    stats.barcode_corrected += 1
 
-                if whitelist_illumina is not None:
-                    if corrected_barcode in whitelist_illumina:
-                        read.set_tag(BARCODE_TAG, corrected_barcode, value_type='Z')
-                    else:
-                        stats.barcode_filtered += 1
-                else:
-                    if whitelist_10x is not None:
-                        if corrected_barcode in whitelist_10x:
-                            read.set_tag(BARCODE_TAG, corrected_barcode, value_type='Z')
-                        else:
-                            stats.barcode_filtered += 1
-                    else:
-                        read.set_tag(BARCODE_TAG, corrected_barcode, value_type='Z')
+class BarcodeTagTransform:
+    """
+    Computes the corrected barcode tag of reads from their raw barcode tag. The correction and the whitelist lookups are done once per
+    raw barcode and cached together with the number of reads of the raw barcode, from which the stats are counted by add_stats().
+    """
+    def __init__(self, correction_dict, whitelist_10x, whitelist_illumina):
+        """
+        :param correction_dict: A dict with the raw barcodes as keys and the corresponding corrected barcodes as values. Must contain '.' for reads without a barcode.
+        :param whitelist_10x: The 10x whitelist. Can be None, unless whitelist_illumina is None.
+        :param whitelist_illumina: The Illumina whitelist. Can be None
+        """
+        self.correction_dict = correction_dict
+        self.whitelist_10x = whitelist_10x
+        self.whitelist_illumina = whitelist_illumina
+        # Raw barcode -> [barcode tag, number of reads, corrected, filtered, corrected from no list to the 10x whitelist]
+        self._transforms = dict()
+
+    def _resolve(self, raw_barcode):
+        """
+        Computes the transform of a raw barcode. If the corrected barcode is not in the whitelist that is used for filtering, the barcode tag keeps the raw barcode.
+        """
+        corrected_barcode = self.correction_dict[raw_barcode]
+        filter_whitelist = self.whitelist_illumina if self.whitelist_illumina is not None else self.whitelist_10x
+        filtered = filter_whitelist is not None and corrected_barcode not in filter_whitelist
+        to_10x = self.whitelist_10x is not None and raw_barcode not in self.whitelist_10x and corrected_barcode in self.whitelist_10x
+        transform = [raw_barcode if filtered else corrected_barcode, 0, raw_barcode != corrected_barcode, filtered, to_10x]
+        self._transforms[raw_barcode] = transform
+        return transform
+
+    def transform(self, read):
+        """
+        Sets the barcode tag of a read, unless it already has the corrected value
+        :param read: The read object with the raw barcode tag
+        """
+        raw_barcode = read.get_tag(RAW_BARCODE_TAG)
+        transform = self._transforms.get(raw_barcode)
+        if transform is None:
+            transform = self._resolve(raw_barcode)
+        transform[1] += 1
+        if not (read.has_tag(BARCODE_TAG) and read.get_tag(BARCODE_TAG) == transform[0]):
+            read.set_tag(BARCODE_TAG, transform[0], value_type='Z')
+
+    def add_stats(self, stats):
+        """
+        Adds the counts of the transformed reads to the stats
+        :param stats: The AnalysisStats object
+        """
+        for _, reads, corrected, filtered, to_10x in self._transforms.values():
+            if corrected:
+                stats.barcode_corrected += reads
+            else:
+                stats.barcode_not_corrected += reads
+            if filtered:
+                stats.barcode_filtered += reads
+            if to_10x:
+                stats.corrected_from_no_list_to_10x += reads
+
+
+class FastqGzWriter:
+    """
+    Writes reads to a gzip compressed FASTQ file with the same records as samtools fastq -T: secondary and supplementary alignments are
+    skipped, reverse strand reads are written in their original orientation, /1 and /2 are appended to the names of paired reads, and
+    the given tags follow the read name. The records are collected into chunks, which are compressed into separate gzip members by a
+    pool of threads and written in order, so that the compression is never done inline with the writing of the reads, even with a
+    single thread. A file of concatenated gzip members is a valid gzip file.
+    """
+    def __init__(self, filename, tags, threads=1, compression_level=FASTQ_COMPRESSION_LEVEL):
+        """
+        :param filename: Filename of the FASTQ file
+        :param tags: List of the tags to write after the read name. Tags that a read does not have are left out.
+        :param threads: Number of threads used for compressing the chunks
+        :param compression_level: gzip compression level
+        """
+        self.file = open(filename, 'wb')
+        self.tags = tags
+        self.compression_level = compression_level
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.max_pending_chunks = 2 * threads
+        self.pending_chunks = collections.deque()
+        self.records = []
+        self.records_size = 0
+
+    def write(self, read):
+        if read.is_secondary or read.is_supplementary:
+            return
+        name = read.query_name
+        if read.is_read1 and not read.is_read2:
+            name += '/1'
+        elif read.is_read2 and not read.is_read1:
+            name += '/2'
+        tags = ''.join('\t{}:Z:{}'.format(tag, read.get_tag(tag)) for tag in self.tags if read.has_tag(tag))
+        sequence = read.get_forward_sequence()
+        qualities = read.get_forward_qualities()
+        quality_string = pysam.qualities_to_qualitystring(qualities) if qualities is not None else FASTQ_DEFAULT_QUALITY * len(sequence)
+        record = '@{}{}\n{}\n+\n{}\n'.format(name, tags, sequence, quality_string)
+        self.records.append(record)
+        self.records_size += len(record)
+        if self.records_size >= FASTQ_CHUNK_SIZE:
+            self._submit_chunk()
+
+    def _compress(self, data):
+        # wbits of 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _submit_chunk(self):
+        data = ''.join(self.records).encode()
+        self.records = []
+        self.records_size = 0
+        # zlib releases the GIL while compressing, so the chunks are compressed in parallel with the reading of the next reads
+        self.pending_chunks.append(self.executor.submit(self._compress, data))
+        while len(self.pending_chunks) >= self.max_pending_chunks:
+            self.file.write(self.pending_chunks.popleft().result())
+
+    def close(self):
+        if self.records:
+            self._submit_chunk()
+        while self.pending_chunks:
+            self.file.write(self.pending_chunks.popleft().result())
+        self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_corrected_reads(correction_dict, analysis_name, stats, whitelist_10x, whitelist_illumina, input_filename=None, annotations_filename=None, adapter_sequence=None, progress_reporter_args=None, regions=None, io_threads=1, fastq_filename=None):
+    """
+    Sets the corrected barcode tags of the annotated reads with a BarcodeTagTransform and writes them to the output BAM file, and
+    optionally to a FASTQ file in the same pass. The throughput of this pass is printed, but not recorded in the stats, so that the
+    stats file is the same on every run.
+    :param correction_dict: A dict with the raw barcodes as keys and the corresponding corrected barcodes as values. Must contain '.' for reads without a barcode.
+    :param analysis_name: Prefix for storing the analysis stats files
+    :param stats: The AnalysisStats object
+    :param whitelist_10x: The 10x whitelist. Can be None or empty, unless whitelist_illumina_filename is None or empty
+    :param whitelist_illumina: The Illumina whitelist. Can be None or empty
+    :param input_filename: Filename of the BAM file to read the reads from. If None, the intermediate file is used.
+    :param annotations_filename: Filename of the annotation spool file written by AnnotationSpoolWriter. Can be None if the reads are taken from the intermediate file.
+    :param adapter_sequence: The adapter sequence. Only needed with an annotation spool file.
+    :param progress_reporter_args: dict of keyword arguments for the ProgressReporter. Can be None to use the defaults.
+    :param regions: The regions the reads were annotated from. Only needed with an annotation spool file.
+    :param io_threads: Number of threads used for decompressing the input file, compressing the output BAM file, and compressing the FASTQ file
+    :param fastq_filename: Filename of the gzip compressed FASTQ file that the reads are also written to, with the FASTQ_TAGS. Can be None to only write the BAM file.
+    """
+    progress_reporter = ProgressReporter('Barcode correction', total_reads=stats.reads_seen, stats=stats, **(progress_reporter_args or dict()))
+    tag_transform = BarcodeTagTransform(correction_dict, whitelist_10x, whitelist_illumina)
+    reads_in_intermediate_file = 0
+    start_time = time.time()
 
-                if whitelist_10x is not None:
-                    if raw_barcode not in whitelist_10x:
-                        if corrected_barcode in whitelist_10x:
-                            stats.corrected_from_no_list_to_10x += 1
+    if input_filename is None:
+        input_filename = analysis_name + '.intermediate.bam'
 
-                output_file.write(read)
+    with pysam.AlignmentFile(input_filename, 'rb', check_sq=False, threads=io_threads) as bam_file:
+        with pysam.AlignmentFile(analysis_name + '.bam', 'wb', check_sq=False, header=bam_file.header, threads=io_threads) as output_file:
+            fastq_file = FastqGzWriter(fastq_filename, FASTQ_TAGS, io_threads) if fastq_filename is not None else None
+            if annotations_filename is not None:
+                reads = read_annotation_spool(bam_file, annotations_filename, adapter_sequence, regions)
+            else:
+                reads = bam_file.fetch(until_eof=True)
+            try:
+                for read in reads:
+                    if reads_in_intermediate_file % READS_PER_BATCH == 0:
+                        progress_reporter.update(reads_in_intermediate_file)
+                    reads_in_intermediate_file += 1
+
+                    tag_transform.transform(read)
+                    output_file.write(read)
+                    if fastq_file is not None:
+                        fastq_file.write(read)
+            finally:
+                if fastq_file is not None:
+                    fastq_file.close()
+
+    tag_transform.add_stats(stats)
+    elapsed_seconds = time.time() - start_time
+    print('Barcode tags rewritten at {:,.0f} reads/s'.format(reads_in_intermediate_file / elapsed_seconds if elapsed_seconds > 0 else 0))
+    progress_reporter.finish(reads_in_intermediate_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -645,11 +2317,26 @@ if __name__ == '__main__':
     parser.add_argument('--whitelist-10x', help='10x whitelist filename. This may be GZIP compressed (has to have extension .gz in that case)')
     parser.add_argument('--whitelist-illumina', help='Illumina whitelist filename. This may be GZIP compressed (has to have extension .gz in that case)')
     parser.add_argument('--max-reads', help='Number of reads after which the processing should be terminated', type=int, default=None)
-    parser.add_argument('--contig', help='Perform analysis only on this contig', default=None)
+    parser.add_argument('--contig', help='Perform analysis only on this contig or region (chr:start-end). The BAM file must be indexed.', default=None)
+    parser.add_argument('--scatter-contigs', action='store_true', help='If enabled, each contig of the indexed BAM file, and the unmapped reads without a position, is annotated as a separate shard, in parallel with --threads. The shards are concatenated in the order of the contigs before the barcode correction, which is performed on all reads together.')
     parser.add_argument('--read-end-length', help='Interval from both ends of the read in which to search for the adapter sequence', type=int, default=80)
-    parser.add_argument('--record-umis', action='store_true', help='If enabled, all barcodes and UMIs will be written to file. This increases memory usage.')
-    parser.add_argument('--ssw-path', help='Path to the Striped Smith-Waterman library', type=str, default='/lrma/ssw')
+    parser.add_argument('--tso-sample-interval', help='Only every n-th read is aligned to the TSO sequence, and the TSO counts in the stats file are extrapolated from these reads. The TSO alignments are only used for these counts, so this saves up to half of the alignment time. 0 to align no read to the TSO sequence, which leaves the TSO counts at 0.', type=int, default=1)
+    parser.add_argument('--record-umis', action='store_true', help='If enabled, all barcodes and UMIs will be written to file. The (barcode, UMI) pairs are counted in packed arrays, which are spilled to the working directory on large runs.')
+    parser.add_argument('--ssw-path', help='Path to the Striped Smith-Waterman library, or to the directory that contains it. The tool exits with an error if the library is not found there. Without this option, the library is searched in {}, the SSW_LIBRARY_PATH environment variable, LD_LIBRARY_PATH, and the Python module search path, and if it is not found, the alignments are computed with numpy, which gives the same results more slowly.'.format(DEFAULT_SSW_PATH), type=str, default=None)
     parser.add_argument('--starcode-path', help='Path to the starcode executable', type=str, default='/lrma/starcode-master/starcode')
+    parser.add_argument('--no-intermediate-bam', action='store_true', help='If enabled, the annotated reads are not written to an intermediate BAM file. Instead, a compact record of the annotations of each read is stored in a side file and all tags are added in a single pass over the input BAM file after barcode correction.')
+    parser.add_argument('--barcode-corrector', help='Barcode correction engine: the starcode executable or the in-process clustering of 2-bit packed barcodes. Both write the clusters to the _starcode.tsv file.', choices=['starcode', 'native'], default='starcode')
+    parser.add_argument('--starcode-counted-input', action='store_true', help='If enabled, each unique barcode is passed to starcode once together with its number of observations, instead of once per observation')
+    parser.add_argument('--threads', help='Number of processes used for annotating the reads. With more than one process, the input is split into shards of consecutive reads that are annotated in parallel.', type=int, default=1)
+    parser.add_argument('--aligner', help='Alignment engine for the read ends: the Striped Smith-Waterman library or the batched numpy aligner of ssw_lib.NumpySsw. Both give the same alignments. The numpy aligner is faster on short read ends, e.g. the default --read-end-length of 80.', choices=['ssw', 'numpy'], default='ssw')
+    parser.add_argument('--alignment-threads', help='Number of threads used for aligning the read ends in each annotating process. The ssw library releases the GIL during each alignment, so the threads can align in parallel without the cost of additional processes. Whether this is faster than --threads alone depends on the machine, see benchmark.py alignment-threads.', type=int, default=1)
+    parser.add_argument('--io-threads', help='Number of threads used for the BGZF compression and decompression of the BAM files of each annotating process, in addition to the annotating processes of --threads. Each annotating process uses this number of threads for its input and intermediate file.', type=int, default=1)
+    parser.add_argument('--output-threads', help='Number of threads used for the BGZF decompression and compression of the BAM files and the compression of the FASTQ file in the barcode correction pass, which runs in a single process after the annotation. Defaults to the larger of --threads and --io-threads.', type=int, default=None)
+    parser.add_argument('--intermediate-compression-level', help='BGZF compression level of the intermediate BAM file, from 0 (uncompressed) to 9. The intermediate file is only read once, so a level of 0 or 1 trades disk space for faster annotation and barcode correction. Defaults to the htslib default level.', type=int, choices=range(10), default=None)
+    parser.add_argument('--fastq', action='store_true', help='If enabled, the annotated reads are also written to the <name>.fastq.gz file while the output BAM file is written, with the same records as samtools fastq -T ZA,CR,ZU,CB. The file is compressed in chunks by --output-threads threads, in parallel with the writing of the output BAM file.')
+    parser.add_argument('--progress-interval', help='Minimum number of seconds between progress reports. At each report, a snapshot of the stats is written to the _stats.partial.tsv file.', type=float, default=PROGRESS_INTERVAL_SECONDS)
+    parser.add_argument('--checkpoint-interval', help='Minimum number of seconds between checkpoints of the annotation. A checkpoint stores the input position, the barcode and UMI counts, and the stats in the .checkpoint file, and a run restarted with the same arguments in the same directory resumes from it. Checkpoints are disabled by default.', type=float, default=None)
+    parser.add_argument('--progress-file', help='JSON file that is replaced with the current stage, number of processed reads, throughput, and estimated time remaining at each progress report', default=None)
 
     args = parser.parse_args()
 
@@ -657,4 +2344,32 @@ if __name__ == '__main__':
         print('Illumina whitelist provided but no 10x whitelist provided.')
         exit(1)
 
-    main(args.bam, args.name, args.adapter, args.reverse_adapter, args.whitelist_10x, args.whitelist_illumina, args.max_reads, args.contig, args.read_end_length, args.record_umis, args.ssw_path, args.starcode_path)
+    if args.tso_sample_interval < 0:
+        print('--tso-sample-interval must not be negative.')
+        exit(1)
+
+    if args.threads < 1:
+        print('--threads must be at least 1.')
+        exit(1)
+
+    if args.io_threads < 1:
+        print('--io-threads must be at least 1.')
+        exit(1)
+
+    if args.output_threads is not None and args.output_threads < 1:
+        print('--output-threads must be at least 1.')
+        exit(1)
+
+    if args.alignment_threads < 1:
+        print('--alignment-threads must be at least 1.')
+        exit(1)
+
+    if args.contig and args.scatter_contigs:
+        print('--contig and --scatter-contigs can not be used together.')
+        exit(1)
+
+    if args.ssw_path is not None and args.aligner == 'ssw' and ssw_lib.find_library(args.ssw_path, bSearch=False) is None:
+        print('{} not found in --ssw-path {}.'.format(ssw_lib.SSW_LIBRARY_NAME, args.ssw_path))
+        exit(1)
+
+    main(args.bam, args.name, args.adapter, args.reverse_adapter, args.whitelist_10x, args.whitelist_illumina, args.max_reads, args.contig, args.read_end_length, args.record_umis, args.ssw_path, args.starcode_path, args.threads, not args.no_intermediate_bam, args.barcode_corrector, args.starcode_counted_input, args.progress_interval, args.progress_file, args.checkpoint_interval, args.scatter_contigs, args.tso_sample_interval, args.io_threads, args.intermediate_compression_level, args.fastq, args.alignment_threads, args.aligner, args.output_threads)
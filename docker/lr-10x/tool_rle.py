@@ -4,7 +4,7 @@ from Bio import pairwise2
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib_venn import venn3
-from Bio.Seq import Seq
+from sequence_utils import reverse_complement
 from multiprocessing import Pool
 import http.client
 import time
@@ -94,7 +94,7 @@ def process_contig_poly_a(contig):
             time_last_segment = time.time()
 
         forward_sequence = read.seq
-        reverse_sequence = str(Seq(forward_sequence).reverse_complement())
+        reverse_sequence = reverse_complement(forward_sequence)
 
         forward_alignments = len(position_in_sequence(forward_sequence, 'TTTTTTTTTTTTTTT'))
         reverse_alignments = len(position_in_sequence(reverse_sequence, 'TTTTTTTTTTTTTTT'))
@@ -150,7 +150,7 @@ def process_contig(contig, include_odd_sequences):
             time_last_segment = time.time()
 
         forward_sequence = read.seq
-        reverse_sequence = str(Seq(forward_sequence).reverse_complement())
+        reverse_sequence = reverse_complement(forward_sequence)
 
         forward_alignments_rk = position_in_sequence(forward_sequence, 'CTACACGACGCTCTTCCGATCT')
         reverse_alignments_rk = position_in_sequence(reverse_sequence, 'CTACACGACGCTCTTCCGATCT')
@@ -0,0 +1,98 @@
+import ctypes
+import os
+import random
+import resource
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'docker', 'lr-10x'))
+
+import ssw_lib  # noqa: E402
+
+
+SSW_PATH = os.environ.get(ssw_lib.SSW_LIBRARY_PATH_ENV, '/lrma/ssw')
+NUM_PAIRS = 100000
+MAX_RSS_GROWTH_MB = 4
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+
+
+def random_numbers(length, rng):
+    return np.array([rng.randrange(4) for _ in range(length)], dtype=np.int8)
+
+
+def to_profile_numbers(numbers):
+    return (ctypes.c_int8 * len(numbers))(*numbers.tolist())
+
+
+@pytest.fixture(scope='module')
+def ssw():
+    if ssw_lib.find_library(SSW_PATH) is None:
+        pytest.skip('libssw.so not found')
+    return ssw_lib.CSsw(SSW_PATH)
+
+
+@pytest.fixture(scope='module')
+def mat():
+    values = [2 if i == j else -2 for i in range(4) for j in range(4)]
+    return (ctypes.c_int8 * len(values))(*values)
+
+
+def test_wrappers_do_not_leak(ssw, mat):
+    rng = random.Random(0)
+    query = to_profile_numbers(random_numbers(22, rng))
+    targets = [random_numbers(80, rng) for _ in range(1000)]
+    batch = np.concatenate(targets)
+    lengths = np.array([len(target) for target in targets])
+    offsets = np.cumsum(lengths) - lengths
+
+    def align_round():
+        with ssw.init_profile(query, len(query), mat, 4, 2) as profile:
+            scores = []
+            for target in targets:
+                with ssw.align(profile, target, len(target), 2, 1, 0, 0, 0, 15) as result:
+                    scores.append(result.contents.nScore)
+            batch_scores, _, _ = ssw.align_batch(profile, batch, offsets, lengths, 2, 1, 15)
+        assert batch_scores.tolist() == scores
+        return 2 * len(targets)
+
+    pairs = align_round()
+    baseline_rss = current_rss_mb()
+    while pairs < NUM_PAIRS:
+        pairs += align_round()
+    assert current_rss_mb() - baseline_rss <= MAX_RSS_GROWTH_MB
+
+
+def test_closed_wrappers_raise(ssw, mat):
+    rng = random.Random(0)
+    query = to_profile_numbers(random_numbers(22, rng))
+    target = random_numbers(80, rng)
+    with ssw.init_profile(query, len(query), mat, 4, 2) as profile:
+        with ssw.align(profile, target, len(target), 2, 1, 0, 0, 0, 15) as result:
+            score = result.contents.nScore
+        with ssw.align(profile, target, len(target), 2, 1, 0, 0, 0, 15) as other_result:
+            assert other_result.contents.nScore == score
+        with pytest.raises(ValueError):
+            result.contents
+    with pytest.raises(ValueError):
+        profile.contents
+
+
+def test_numpy_aligner_matches_ssw(ssw, mat):
+    rng = random.Random(1)
+    numpy_ssw = ssw_lib.NumpySsw()
+    query = to_profile_numbers(random_numbers(22, rng))
+    targets = [random_numbers(rng.randrange(1, 120), rng) for _ in range(500)]
+    batch = np.concatenate(targets)
+    lengths = np.array([len(target) for target in targets])
+    offsets = np.cumsum(lengths) - lengths
+    with ssw.init_profile(query, len(query), mat, 4, 2) as profile, numpy_ssw.init_profile(query, len(query), mat, 4, 2) as numpy_profile:
+        expected = ssw.align_batch(profile, batch, offsets, lengths, 2, 1, 15)
+        actual = numpy_ssw.align_batch(numpy_profile, batch, offsets, lengths, 2, 1, 15)
+    for expected_values, actual_values in zip(expected, actual):
+        assert expected_values.tolist() == actual_values.tolist()
@@ -0,0 +1,304 @@
+import gzip
+import os
+import pickle
+import random
+import sys
+
+import numpy as np
+import pysam
+import pytest
+
+LR_10X_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', '..', 'docker', 'lr-10x')
+sys.path.insert(0, LR_10X_DIRECTORY)
+
+import benchmark  # noqa: E402
+import tool  # noqa: E402
+
+
+def random_sequence(length, rng, alphabet='ACGT'):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def test_pack_sequences_round_trip():
+    rng = random.Random(0)
+    sequences = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(1000)]
+    invalid = ['ACGTN' + sequences[0][5:], sequences[1][:-1], '']
+    packed, valid = tool.pack_sequences(sequences + invalid, tool.BARCODE_LENGTH)
+
+    assert valid.tolist() == [True] * len(sequences) + [False] * len(invalid)
+    assert tool.unpack_sequences(packed[valid], tool.BARCODE_LENGTH) == sequences
+    assert packed[~valid].tolist() == [0] * len(invalid)
+    assert packed[valid].tolist() == [int(sequence.translate(str.maketrans('ACGT', '0123')), 4) for sequence in sequences]
+
+
+@pytest.mark.parametrize('suffix, compressed', [('', False), ('-1', False), ('-1', True), ('mixed', False)])
+def test_read_barcodes(tmp_path, suffix, compressed):
+    rng = random.Random(1)
+    barcodes = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(2000)]
+    lines = [barcode + (suffix if suffix != 'mixed' else rng.choice(['', '-1'])) for barcode in barcodes + barcodes[:100]]
+    if suffix == 'mixed':
+        lines += ['ACGTN' + barcodes[0][5:], barcodes[1][:-1]]
+    filename = str(tmp_path / ('whitelist.txt' + ('.gz' if compressed else '')))
+    with (gzip.open(filename, 'wt') if compressed else open(filename, 'w')) as whitelist_file:
+        whitelist_file.write(''.join(line + '\n' for line in lines))
+
+    whitelist = tool.read_barcodes(filename)
+    expected = set(barcodes)
+    assert len(whitelist) == len(expected)
+
+    queries = barcodes[:500] + [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(500)] + ['ACGTN' + barcodes[0][5:], barcodes[0][:-1]]
+    assert [query in whitelist for query in queries] == [query in expected for query in queries]
+
+    codes = tool.BASE_CODES[np.frombuffer(''.join(queries[:1000]).encode('ascii'), dtype=np.uint8).reshape(-1, tool.BARCODE_LENGTH)]
+    assert whitelist.contains_codes(codes).tolist() == [query in expected for query in queries[:1000]]
+
+
+def test_read_barcodes_cache(tmp_path):
+    rng = random.Random(2)
+    barcodes = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(100)]
+    filename = str(tmp_path / 'whitelist.txt')
+    with open(filename, 'w') as whitelist_file:
+        whitelist_file.write(''.join(barcode + '\n' for barcode in barcodes))
+
+    whitelist = tool.read_barcodes(filename, write_cache=True)
+    assert os.path.exists(filename + '.npy')
+    cached_whitelist = tool.read_barcodes(filename)
+    assert cached_whitelist.packed_barcodes.tolist() == whitelist.packed_barcodes.tolist()
+
+
+def test_read_empty_barcodes(tmp_path):
+    filename = str(tmp_path / 'whitelist.txt')
+    open(filename, 'w').close()
+
+    whitelist = tool.read_barcodes(filename)
+    assert len(whitelist) == 0
+    assert 'A' * tool.BARCODE_LENGTH not in whitelist
+    codes = np.zeros((3, tool.BARCODE_LENGTH), dtype=np.uint8)
+    assert whitelist.contains_codes(codes).tolist() == [False] * 3
+
+
+class Interrupted(Exception):
+    pass
+
+
+def read_adapter_sequences():
+    sequences = []
+    for fasta_filename in ('adapter_sequence.fasta', 'reverse_adapter_sequence.fasta'):
+        with open(os.path.join(LR_10X_DIRECTORY, fasta_filename)) as fasta_file:
+            sequences.append(''.join(fasta_file.read().split('\n')[1:]))
+    return sequences
+
+
+def write_simulated_bam(bam_filename, num_reads, seed):
+    rng = random.Random(seed)
+    adapter_sequence, tso_sequence = read_adapter_sequences()
+    cells = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(20)]
+    sequences, _ = benchmark.simulate_reads(num_reads, cells, adapter_sequence, tso_sequence, 0.9, 0.1, rng)
+    benchmark.write_reads(bam_filename, sequences)
+    return cells
+
+
+def test_annotate_reads_matches_annotate_read(tmp_path):
+    cells = write_simulated_bam(str(tmp_path / 'reads.bam'), 1500, 6)
+    with pysam.AlignmentFile(str(tmp_path / 'reads.bam'), 'rb', check_sq=False) as bam_file:
+        reads = list(bam_file.fetch(until_eof=True))
+    # Half of the cells are in the whitelist, so that both the whitelisted and the other barcodes are counted
+    whitelist = tool.BarcodeWhitelist(np.sort(tool.pack_sequences(cells[::2], tool.BARCODE_LENGTH)[0].astype(np.uint32)))
+    adapter_sequence, tso_sequence = read_adapter_sequences()
+
+    with tool.create_aligner(None, adapter_sequence, tso_sequence) as aligner:
+        expected_stats = tool.AnalysisStats()
+        expected = [tool.annotate_read(read, expected_stats, aligner, 120, whitelist, None) for read in reads]
+        stats = tool.AnalysisStats()
+        annotations = []
+        for batch in tool.read_batches(reads, 400):
+            annotations.extend(tool.annotate_reads(batch, stats, aligner, 120, whitelist, None))
+
+    assert annotations == expected
+    assert vars(stats) == vars(expected_stats)
+    assert stats.barcode_in_10x_whitelist > 0 and stats.barcode_not_in_any_whitelist > 0
+
+
+def run_tool(name, bam_filename, threads, checkpoint_interval=None, contig=None, scatter_contigs=False):
+    tool.main(bam_filename, name, os.path.join(LR_10X_DIRECTORY, 'adapter_sequence.fasta'), os.path.join(LR_10X_DIRECTORY, 'reverse_adapter_sequence.fasta'),
+              None, None, None, contig, 120, True, None, None, threads=threads, barcode_corrector='native', checkpoint_interval=checkpoint_interval,
+              scatter_contigs=scatter_contigs, tso_sample_interval=3, alignment_engine='numpy')
+
+
+def read_outputs(name):
+    with pysam.AlignmentFile(name + '.bam', 'rb', check_sq=False) as bam_file:
+        reads = [(read.query_name, sorted(read.get_tags())) for read in bam_file]
+    with open(name + '_stats.tsv') as stats_file, open(name + '_barcode_stats.tsv') as barcode_stats_file:
+        return reads, stats_file.read(), barcode_stats_file.read()
+
+
+@pytest.mark.parametrize('threads', [2, 3])
+def test_parallel_matches_serial(tmp_path, monkeypatch, threads):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tool, 'READS_PER_BATCH', 200)
+    monkeypatch.setattr(tool, 'READS_PER_SHARD', 400)
+    write_simulated_bam('reads.bam', 2000, 7)
+    run_tool('serial', 'reads.bam', 1)
+    run_tool('parallel', 'reads.bam', threads)
+
+    serial_reads, serial_stats, serial_barcode_stats = read_outputs('serial')
+    assert len(serial_reads) == 2000
+    assert read_outputs('parallel') == (serial_reads, serial_stats, serial_barcode_stats)
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_resume_from_checkpoint(tmp_path, monkeypatch, capsys, threads):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tool, 'READS_PER_BATCH', 200)
+    monkeypatch.setattr(tool, 'READS_PER_SHARD', 400)
+    write_simulated_bam('reads.bam', 2000, 3)
+    run_tool('uninterrupted', 'reads.bam', threads)
+
+    saves = []
+    save = tool.AnnotationCheckpoint.save
+
+    def interrupted_save(checkpoint, state):
+        save(checkpoint, state)
+        saves.append(state['stats'].reads_seen)
+        if len(saves) == 2:
+            raise Interrupted()
+
+    with monkeypatch.context() as interruption:
+        interruption.setattr(tool.AnnotationCheckpoint, 'save', interrupted_save)
+        with pytest.raises(Interrupted):
+            run_tool('resumed', 'reads.bam', threads, checkpoint_interval=1e-9)
+    assert os.path.exists('resumed.checkpoint')
+    assert 0 < saves[-1] < 2000
+
+    capsys.readouterr()
+    run_tool('resumed', 'reads.bam', threads, checkpoint_interval=1e-9)
+    assert 'Resuming from checkpoint after {:,} reads'.format(saves[-1]) in capsys.readouterr().out
+    assert not os.path.exists('resumed.checkpoint')
+    assert read_outputs('resumed') == read_outputs('uninterrupted')
+
+
+def write_sorted_bam(bam_filename, num_reads, seed):
+    """
+    Writes the simulated reads to an indexed, coordinate-sorted BAM file, the first 80% as mapped to three contigs and the others as
+    unmapped reads without a position. Returns the names of the reads of each region, with '*' for the unmapped reads.
+    """
+    write_simulated_bam(bam_filename + '.unsorted', num_reads, seed)
+    with pysam.AlignmentFile(bam_filename + '.unsorted', 'rb', check_sq=False) as unsorted_file:
+        reads = list(unsorted_file.fetch(until_eof=True))
+    contigs = ['chr1', 'chr2', 'chr3']
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': contig, 'LN': 10 * num_reads} for contig in contigs]}
+    contig_reads = {contig: [] for contig in contigs + ['*']}
+    with pysam.AlignmentFile(bam_filename, 'wb', header=header) as bam_file:
+        num_mapped_reads = int(0.8 * len(reads))
+        for i, unsorted_read in enumerate(reads):
+            read = pysam.AlignedSegment(bam_file.header)
+            read.query_name = unsorted_read.query_name
+            read.query_sequence = unsorted_read.query_sequence
+            read.query_qualities = unsorted_read.query_qualities
+            if i < num_mapped_reads:
+                contig = contigs[i * len(contigs) // num_mapped_reads]
+                read.flag = 0
+                read.reference_name = contig
+                read.reference_start = i
+                read.mapping_quality = 60
+                read.cigarstring = '{}M'.format(len(read.query_sequence))
+                contig_reads[contig].append(read.query_name)
+            else:
+                read.flag = 4
+                contig_reads['*'].append(read.query_name)
+            bam_file.write(read)
+    pysam.index(bam_filename)
+    return contig_reads
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_scatter_contigs_matches_serial(tmp_path, monkeypatch, threads):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tool, 'READS_PER_BATCH', 200)
+    monkeypatch.setattr(tool, 'READS_PER_SHARD', 400)
+    write_sorted_bam('reads.bam', 2000, 8)
+    assert tool.list_contig_regions('reads.bam') == ['chr1', 'chr2', 'chr3', '*']
+    run_tool('serial', 'reads.bam', 1)
+    run_tool('scattered', 'reads.bam', threads, scatter_contigs=True)
+
+    serial_reads, serial_stats, serial_barcode_stats = read_outputs('serial')
+    assert len(serial_reads) == 2000
+    assert read_outputs('scattered') == (serial_reads, serial_stats, serial_barcode_stats)
+
+
+def test_contig_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    contig_reads = write_sorted_bam('reads.bam', 1000, 9)
+    with pysam.AlignmentFile('reads.bam', 'rb') as bam_file:
+        assert [read.query_name for read in tool.fetch_reads(bam_file, ['chr2', '*'])] == contig_reads['chr2'] + contig_reads['*']
+    run_tool('serial', 'reads.bam', 1)
+    run_tool('chr2', 'reads.bam', 1, contig='chr2')
+
+    serial_reads = dict(read_outputs('serial')[0])
+    chr2_reads, chr2_stats, _ = read_outputs('chr2')
+    assert [name for name, _ in chr2_reads] == contig_reads['chr2']
+    # The barcodes of all reads are corrected together in the serial run, so only the raw annotations are compared
+    raw_tags = (tool.ADAPTER_TAG, tool.RAW_BARCODE_TAG, tool.UMI_TAG)
+    assert [(name, [tag for tag in tags if tag[0] in raw_tags]) for name, tags in chr2_reads] == \
+        [(name, [tag for tag in serial_reads[name] if tag[0] in raw_tags]) for name in contig_reads['chr2']]
+    stats_header, stats_values = chr2_stats.splitlines()[:2]
+    assert dict(zip(stats_header.split('\t'), stats_values.split('\t')))['reads_seen'] == str(len(contig_reads['chr2']))
+
+
+def simulate_barcode_umi_pairs(num_pairs, rng):
+    barcodes = [random_sequence(tool.BARCODE_LENGTH, rng) for _ in range(50)]
+    umis = [random_sequence(tool.UMI_LENGTH, rng) for _ in range(200)]
+    pairs = [(rng.choice(barcodes), rng.choice(umis)) for _ in range(num_pairs)]
+    # Pairs that can not be packed are counted separately
+    pairs[::97] = [(barcode[:-1] + 'N', umi) for barcode, umi in pairs[::97]]
+    return pairs
+
+
+def count_pairs(pairs, spill_directory):
+    counter = tool.BarcodeUmiCounter(str(spill_directory))
+    for barcode, umi in pairs:
+        counter.add(barcode, umi)
+    return counter
+
+
+def force_spilling(monkeypatch):
+    monkeypatch.setattr(tool, 'COUNTER_BUFFER_SIZE', 64)
+    monkeypatch.setattr(tool, 'COUNTER_MAX_RUNS', 3)
+    monkeypatch.setattr(tool, 'COUNTER_SPILL_ENTRIES', 100)
+
+
+def test_counter_spill_and_merge(tmp_path, monkeypatch):
+    pairs = simulate_barcode_umi_pairs(20000, random.Random(4))
+    expected = dict()
+    for pair in pairs:
+        expected[pair] = expected.get(pair, 0) + 1
+
+    in_memory_counter = count_pairs(pairs, tmp_path)
+    assert list(in_memory_counter.items()) == list(expected.items())
+    assert not in_memory_counter._spilled_runs
+
+    force_spilling(monkeypatch)
+    spilled_counter = count_pairs(pairs, tmp_path)
+    assert spilled_counter._spilled_runs
+    assert list(spilled_counter.items()) == list(expected.items())
+
+    # Counters of consecutive shards, as merged by annotate_parallel()
+    merged_counter = count_pairs(pairs[:7000], tmp_path)
+    for start, end in ((7000, 7001), (7001, 15000), (15000, 20000)):
+        merged_counter.merge(count_pairs(pairs[start:end], tmp_path))
+    assert merged_counter.observations == len(pairs)
+    assert list(merged_counter.items()) == list(expected.items())
+
+    for counter in (spilled_counter, merged_counter):
+        counter.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_counter_pickle(tmp_path, monkeypatch):
+    force_spilling(monkeypatch)
+    pairs = simulate_barcode_umi_pairs(5000, random.Random(5))
+    counter = count_pairs(pairs[:3000], tmp_path)
+    counter = pickle.loads(pickle.dumps(counter))
+    for barcode, umi in pairs[3000:]:
+        counter.add(barcode, umi)
+    assert list(counter.items()) == list(count_pairs(pairs, tmp_path).items())